@@ -0,0 +1,45 @@
+# Benchmark of Multiplicity._transformData against the previous
+# implementation (Python loop over all tracksters).
+#
+# A synthetic vertices_x array of shape (events, tracksters, vertices) is built
+# in memory, so no ROOT file is needed. Run from python/ directory:
+#       python -m benchmarks.bench_multiplicity --events 1000 10000
+import argparse
+import timeit
+import numpy as np
+import awkward as ak
+from validation.DataProcessor import Multiplicity
+
+def makeVertices(n_events, mean_tracksters=20, mean_vertices=30, seed=0):
+    rng = np.random.default_rng(seed)
+    n_tracksters = rng.poisson(mean_tracksters, n_events)
+    n_vertices = rng.poisson(mean_vertices, np.sum(n_tracksters))
+    vertices = rng.normal(0., 50., np.sum(n_vertices)).astype(np.float32)
+
+    return ak.unflatten(ak.unflatten(vertices, n_vertices), n_tracksters)
+
+def loopMultiplicity(raw_data):
+    flattened_data = ak.flatten(raw_data)
+    return np.array([len(trackster) for trackster in flattened_data])
+
+def main():
+    parser = argparse.ArgumentParser(description='Multiplicity benchmark')
+    parser.add_argument('--events', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f'{"events":>10} {"tracksters":>12} {"loop (s)":>12} {"ak.num (s)":>12} {"speedup":>10}')
+    for n_events in args.events:
+        raw_data = makeVertices(n_events)
+        if not np.array_equal(loopMultiplicity(raw_data), Multiplicity._transformData(raw_data)):
+            raise RuntimeError('vectorized multiplicity differs from the loop')
+
+        t_loop = min(timeit.repeat(lambda: loopMultiplicity(raw_data),\
+                                   number=1, repeat=args.repeat))
+        t_vec = min(timeit.repeat(lambda: Multiplicity._transformData(raw_data),\
+                                  number=1, repeat=args.repeat))
+        n_tracksters = int(np.sum(ak.num(raw_data)))
+        print(f'{n_events:>10} {n_tracksters:>12} {t_loop:>12.4f} {t_vec:>12.6f} {t_loop/t_vec:>10.0f}')
+
+if __name__ == '__main__':
+    main()
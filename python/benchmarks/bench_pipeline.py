@@ -0,0 +1,135 @@
+# Benchmark of the whole validation chain on synthetic ticlDumper files (see
+# synthetic.py). Run from python/ directory:
+#       python -m benchmarks.bench_pipeline --events 100 1000 --pileup PU0
+#
+# For each number of events a file is generated once in --workdir and the
+# following stages are timed (minimum over --repeat runs):
+#       DataFile.open        - DataFile() (metadata only)
+#       DataFile.read        - all the columns of clusters and tracks TTrees
+#       DataFile.iterate     - the same columns in chunks of --step events
+#       zToIDMap             - map computed from clusters (not from map_dir)
+#       DataFile.read [RNTuple]
+#                            - all the columns of Multiplicity and Combination
+#       Multiplicity.getData [RNTuple], Combination.getData [RNTuple]
+#       NTupler.makeHist     - histograms of Multiplicity with Combination bins
+#       Plotter.makePlots    - first --plots histograms, one process
+#
+# Tracksters are stored as RNTuples in synthetic files (see synthetic.py), so
+# the stages marked [RNTuple] time uproot's RNTuple reader, not the TTree
+# baskets of production ticlDumper files.
+#
+# Use --output to save the timings in .json and --compare to check them
+# against timings saved before: the script fails if any stage is slower than
+# in the reference by more than --tolerance (relative).
+import argparse
+import json
+import os
+import sys
+import timeit
+import matplotlib
+matplotlib.use('Agg')
+from validation.DataFile import DataFile
+from validation.DataProcessor import DataProcessor, Multiplicity, Combination
+from validation.NTupler import NTupler
+from validation.Plotter import Plotter
+from benchmarks.synthetic import makeDumperFile
+
+STAGES = ['DataFile.open', 'DataFile.read', 'DataFile.iterate', 'zToIDMap',\
+          'DataFile.read [RNTuple]', 'Multiplicity.getData [RNTuple]',\
+          'Combination.getData [RNTuple]', 'NTupler.makeHist', 'Plotter.makePlots']
+
+# columns of TTrees of synthetic files
+TRACK_KEYS = ['track_id', 'track_pt', 'track_quality', 'track_hgcal_x', 'track_hgcal_y',\
+              'track_hgcal_z', 'track_hgcal_eta', 'track_hgcal_phi']
+TTREE_COLUMNS = DataProcessor.map_columns + [('ticlDumper/tracks;1', key) for key in TRACK_KEYS]
+
+def benchFile(filepath, workdir, repeat=3, n_plots=3, step_size=100):
+    def best(function):
+        return min(timeit.repeat(function, number=1, repeat=repeat))
+
+    def getData(processor_class):
+        processor = processor_class()
+        processor.getData(DataFile(filepath, cache_size=0))
+        return processor
+
+    columns = Multiplicity().columns() + Combination().columns()
+    ntuple = os.path.join(workdir, 'multiplicity_bench.json')
+    multiplicity, combination = getData(Multiplicity), getData(Combination)
+
+    def iterate():
+        for _ in DataFile(filepath, cache_size=0).iterate(TTREE_COLUMNS, step_size=step_size):
+            pass
+
+    timings = {
+        'DataFile.open': best(lambda: DataFile(filepath)),
+        'DataFile.read': best(lambda: DataFile(filepath, cache_size=0).openArrays(TTREE_COLUMNS)),
+        'DataFile.iterate': best(iterate),
+        'zToIDMap': best(lambda: DataProcessor().zToIDMap(DataFile(filepath), geometry=None)),
+        'DataFile.read [RNTuple]': best(lambda: DataFile(filepath, cache_size=0).openArrays(columns)),
+        'Multiplicity.getData [RNTuple]': best(lambda: getData(Multiplicity)),
+        'Combination.getData [RNTuple]': best(lambda: getData(Combination)),
+        'NTupler.makeHist': best(lambda: NTupler(multiplicity.data, combination.data,\
+                                                 output=ntuple).makeHist())
+    }
+
+    plot_dir = os.path.join(workdir, 'plots')
+    os.makedirs(plot_dir, exist_ok=True)
+    def makePlots():
+        plotter = Plotter(ntuple, plot_dir)
+        plotter.file = {name: plotter.file[name] for name in list(plotter.file)[:n_plots]}
+        plotter.makePlots(workers=1, force=True)
+    timings['Plotter.makePlots'] = best(makePlots)
+
+    return timings
+
+def compare(results, reference, tolerance):
+    regressions = []
+    for n_events, timings in results.items():
+        for stage, time in timings.items():
+            reference_time = reference.get(n_events, {}).get(stage)
+            if reference_time is not None and time > reference_time*(1 + tolerance):
+                regressions.append(f'{stage} at {n_events} events: {time:.4f} s'\
+                                   + f' (reference {reference_time:.4f} s)')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Validation chain benchmark')
+    parser.add_argument('--events', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--pileup', default='PU0', choices=['PU0', 'PU200'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--plots', type=int, default=3, help='number of histograms to plot')
+    parser.add_argument('--step', type=int, default=100, help='events per chunk of DataFile.iterate')
+    parser.add_argument('--workdir', default='bench_files')
+    parser.add_argument('--output', default=None, help='.json file to save timings')
+    parser.add_argument('--compare', default=None, help='.json file with reference timings')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    results = {}
+    for n_events in args.events:
+        # no geometry in the name of file, so zToIDMap is always computed
+        filepath = os.path.join(args.workdir, f'synthetic_{args.pileup}_{n_events}.root')
+        if not os.path.exists(filepath):
+            makeDumperFile(filepath, n_events, args.pileup)
+        results[str(n_events)] = benchFile(filepath, args.workdir, args.repeat, args.plots, args.step)
+
+    print(f'{"stage":<32}' + ''.join(f'{n_events + " ev (s)":>16}' for n_events in results))
+    for stage in STAGES:
+        print(f'{stage:<32}' + ''.join(f'{timings[stage]:>16.4f}' for timings in results.values()))
+
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump({'pileup': args.pileup, 'timings': results}, file, indent=4)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as file:
+            reference = json.load(file)
+        regressions = compare(results, reference['timings'], args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION: {regression}')
+        if len(regressions) > 0:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
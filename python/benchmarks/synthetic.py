@@ -0,0 +1,199 @@
+# Generator of synthetic ticlDumper files, so that the validation can be
+# benchmarked without the real inputs. Run from python/ directory:
+#       python -m benchmarks.synthetic --events 1000 --pileup PU200 --output dumper.root
+#
+# The file contains the branches used by the processors:
+#       ticlDumper/clusters                       - position_z, cluster_layer_id
+#       ticlDumper/trackstersCLUE3DHigh, trackstersSuperclusteringDNN,
+#       trackstersTiclCandidate, simtrackstersCP, simtrackstersSC
+#                                                 - energies, barycenter, PCA,
+#                                                   vertices_x/y/z, ...
+#       ticlDumper/associations                   - tsCLUE3D_simToReco_CP and
+#                                                   tsCLUE3D_recoToSim_CP (+ _score)
+# Numbers of objects per event are Poisson distributed around the means of
+# SCALES (PU0 or PU200). Vertices lie on the layers of LAYER_Z and every layer
+# has clusters, so zToIDMap() works on any generated file.
+#
+#       ticlDumper/tracks                         - track_pt, track_hgcal_*, ...
+#
+# Trees with at most singly jagged branches (clusters, tracks) are written as
+# TTrees, as in production ticlDumper files. uproot can not write doubly jagged
+# arrays (e.g. vertices_x, associations) into TTrees, so tracksters and
+# associations are written as RNTuples. DataFile reads both in the same way.
+import argparse
+import numpy as np
+import awkward as ak
+import uproot as ur
+
+LAYER_Z = np.linspace(320., 520., 47)
+
+# mean number of objects per event and of vertices per trackster
+SCALES = {
+    'PU0': {
+        'clusters': 500,
+        'trackstersCLUE3DHigh': 20,
+        'trackstersSuperclusteringDNN': 5,
+        'trackstersTiclCandidate': 5,
+        'simtrackstersCP': 2,
+        'simtrackstersSC': 4,
+        'vertices': 20,
+        'matches': 3,
+        'tracks': 10
+    },
+    'PU200': {
+        'clusters': 20000,
+        'trackstersCLUE3DHigh': 1500,
+        'trackstersSuperclusteringDNN': 400,
+        'trackstersTiclCandidate': 400,
+        'simtrackstersCP': 300,
+        'simtrackstersSC': 600,
+        'vertices': 10,
+        'matches': 5,
+        'tracks': 500
+    }
+}
+
+TRACKSTERS = ['trackstersCLUE3DHigh', 'trackstersSuperclusteringDNN', 'trackstersTiclCandidate',\
+              'simtrackstersCP', 'simtrackstersSC']
+
+def makeDumperFile(output, n_events=1000, pileup='PU0', seed=0):
+    if pileup not in SCALES:
+        raise KeyError(f'pileup = {pileup} is unavailable. Available: {list(SCALES.keys())}')
+    scale = SCALES[pileup]
+    rng = np.random.default_rng(seed)
+
+    counts = {name: np.maximum(rng.poisson(scale[name], n_events), 1) for name in TRACKSTERS}
+    with ur.recreate(output) as file:
+        writeTTree(file, 'ticlDumper/clusters', makeClusters(rng, n_events, scale['clusters']))
+        writeTTree(file, 'ticlDumper/tracks', makeTracks(rng, n_events, scale['tracks']))
+        for name in TRACKSTERS:
+            file.mkrntuple(f'ticlDumper/{name}', makeTracksters(rng, counts[name], scale['vertices']))
+
+        sim_counts, reco_counts = counts['simtrackstersCP'], counts['trackstersCLUE3DHigh']
+        sim_to_reco, sim_to_reco_score = makeAssociation(rng, sim_counts, reco_counts,\
+                                                         scale['matches'])
+        reco_to_sim, reco_to_sim_score = makeAssociation(rng, reco_counts, sim_counts, 1)
+        file.mkrntuple('ticlDumper/associations', ak.Array({
+            'tsCLUE3D_simToReco_CP': sim_to_reco,
+            'tsCLUE3D_simToReco_CP_score': sim_to_reco_score,
+            'tsCLUE3D_recoToSim_CP': reco_to_sim,
+            'tsCLUE3D_recoToSim_CP_score': reco_to_sim_score
+        }))
+    return output
+
+# Branches are jagged arrays of numbers (one list per event), uproot adds a
+# counter branch for each of them
+def writeTTree(file, name, arrays):
+    tree = file.mktree(name, {key: arrays[key].type.content for key in arrays.fields})
+    tree.extend({key: arrays[key] for key in arrays.fields})
+    return tree
+
+def makeClusters(rng, n_events, mean_clusters):
+    n_clusters = np.maximum(rng.poisson(mean_clusters, n_events), 1)
+    layer_id = rng.integers(1, len(LAYER_Z) + 1, np.sum(n_clusters))
+    # each layer has at least one cluster
+    n_first = min(len(LAYER_Z), len(layer_id))
+    layer_id[:n_first] = np.arange(1, n_first + 1)
+    position_z = (LAYER_Z[layer_id - 1] - rng.uniform(0., 2., len(layer_id)))\
+                 * rng.choice([-1., 1.], len(layer_id))
+
+    return ak.Array({
+        'position_z': ak.unflatten(position_z.astype(np.float32), n_clusters),
+        'cluster_layer_id': ak.unflatten(layer_id.astype(np.int32), n_clusters)
+    })
+
+def makeTracks(rng, n_events, mean_tracks):
+    n_tracks = np.maximum(rng.poisson(mean_tracks, n_events), 1)
+    total = np.sum(n_tracks)
+
+    side = rng.choice([-1., 1.], total)
+    eta = rng.uniform(1.6, 2.9, total)*side
+    phi = rng.uniform(-np.pi, np.pi, total)
+    radius = LAYER_Z[0]/np.sinh(np.abs(eta))
+
+    def perTrack(values, dtype=np.float32):
+        return ak.unflatten(values.astype(dtype), n_tracks)
+
+    return ak.Array({
+        'track_id': perTrack(np.arange(total), np.uint32),
+        'track_pt': perTrack(rng.exponential(5., total)),
+        'track_quality': perTrack(rng.integers(0, 2, total), np.int32),
+        'track_hgcal_x': perTrack(radius*np.cos(phi)),
+        'track_hgcal_y': perTrack(radius*np.sin(phi)),
+        'track_hgcal_z': perTrack(LAYER_Z[0]*side),
+        'track_hgcal_eta': perTrack(eta),
+        'track_hgcal_phi': perTrack(phi)
+    })
+
+def makeTracksters(rng, n_tracksters, mean_vertices):
+    total = np.sum(n_tracksters)
+    n_vertices = np.maximum(rng.poisson(mean_vertices, total), 1)
+    n_total_vertices = np.sum(n_vertices)
+
+    side = rng.choice([-1., 1.], total)
+    eta = rng.uniform(1.6, 2.9, total)*side
+    phi = rng.uniform(-np.pi, np.pi, total)
+    energy = rng.exponential(20., total)
+    barycenter_z = rng.uniform(LAYER_Z[0], LAYER_Z[-1], total)*side
+    radius = np.abs(barycenter_z)/np.sinh(np.abs(eta))
+
+    # vertices are spread around the axis of trackster
+    vertex_side = np.repeat(side, n_vertices)
+    vertex_z = LAYER_Z[rng.integers(0, len(LAYER_Z), n_total_vertices)]*vertex_side
+    vertex_radius = np.abs(vertex_z)/np.sinh(np.abs(np.repeat(eta, n_vertices)))
+    vertex_phi = np.repeat(phi, n_vertices)
+
+    def perTrackster(values):
+        return ak.unflatten(values.astype(np.float32), n_tracksters)
+
+    def perVertex(values):
+        return ak.unflatten(ak.unflatten(values.astype(np.float32), n_vertices), n_tracksters)
+
+    direction = np.stack([np.cos(phi)/np.cosh(eta), np.sin(phi)/np.cosh(eta), np.tanh(eta)])
+    return ak.Array({
+        'NTracksters': n_tracksters.astype(np.uint32),
+        'raw_energy': perTrackster(energy),
+        'regressed_energy': perTrackster(energy*rng.normal(1., 0.1, total)),
+        'raw_pt': perTrackster(energy/np.cosh(eta)),
+        'barycenter_eta': perTrackster(eta),
+        'barycenter_phi': perTrackster(phi),
+        'barycenter_x': perTrackster(radius*np.cos(phi)),
+        'barycenter_y': perTrackster(radius*np.sin(phi)),
+        'barycenter_z': perTrackster(barycenter_z),
+        'eVector0_x': perTrackster(direction[0]),
+        'eVector0_y': perTrackster(direction[1]),
+        'eVector0_z': perTrackster(direction[2]),
+        'EV1': perTrackster(rng.exponential(10., total)),
+        'EV2': perTrackster(rng.exponential(1., total)),
+        'EV3': perTrackster(rng.exponential(0.1, total)),
+        'vertices_x': perVertex(vertex_radius*np.cos(vertex_phi) + rng.normal(0., 1., n_total_vertices)),
+        'vertices_y': perVertex(vertex_radius*np.sin(vertex_phi) + rng.normal(0., 1., n_total_vertices)),
+        'vertices_z': perVertex(vertex_z)
+    })
+
+# Each source object is matched to up to mean_matches + 1 random targets of
+# its event. Matches are sorted by score, so the first one is the best
+def makeAssociation(rng, n_sources, n_targets, mean_matches):
+    total = np.sum(n_sources)
+    targets_per_source = np.repeat(n_targets, n_sources)
+    n_matches = np.minimum(rng.poisson(mean_matches, total) + 1, targets_per_source)
+
+    index = np.floor(rng.uniform(0., 1., np.sum(n_matches))\
+                     * np.repeat(targets_per_source, n_matches)).astype(np.uint32)
+    score = ak.sort(ak.unflatten(rng.uniform(0., 1., len(index)).astype(np.float32), n_matches))
+
+    return ak.unflatten(ak.unflatten(index, n_matches), n_sources),\
+           ak.unflatten(score, n_sources)
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic ticlDumper file')
+    parser.add_argument('--events', type=int, default=1000)
+    parser.add_argument('--pileup', default='PU0', choices=list(SCALES.keys()))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='dumper.root')
+    args = parser.parse_args()
+
+    makeDumperFile(args.output, args.events, args.pileup, args.seed)
+
+if __name__ == '__main__':
+    main()
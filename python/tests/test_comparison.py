@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+from scipy.stats import chi2_contingency, ks_2samp
+from validation.Comparison import Comparison
+from validation.Histogram import Histogram
+from validation.Storage import openStorage
+
+def test_chi2_matches_contingency_table():
+    reference = np.array([10., 25., 40., 0., 12.])
+    target = np.array([14., 20., 52., 0., 5.])
+    result = Comparison.testCounts([reference], [target])
+
+    non_empty = (reference + target) > 0
+    table = np.stack([reference[non_empty], target[non_empty]])
+    chi2, p_value, ndf, _ = chi2_contingency(table, correction=False)
+    assert result['chi2'][0] == pytest.approx(chi2)
+    assert result['p_chi2'][0] == pytest.approx(p_value)
+    assert result['ndf'][0] == ndf
+
+def test_ks_distance_matches_samples():
+    reference = np.array([3., 5., 8., 2.])
+    target = np.array([1., 4., 6., 9.])
+    result = Comparison.testCounts([reference], [target])
+
+    bins = np.arange(4)
+    statistic = ks_2samp(np.repeat(bins, reference.astype(int)),\
+                         np.repeat(bins, target.astype(int))).statistic
+    assert result['ks'][0] == pytest.approx(statistic)
+
+def test_histograms_of_different_length_are_padded():
+    reference = [np.array([1., 2., 3.]), np.array([5., 5.])]
+    target = [np.array([1., 2., 3.]), np.array([5., 5.])]
+    result = Comparison.testCounts(reference, target)
+
+    assert np.allclose(result['chi2'], 0.)
+    assert np.allclose(result['p_chi2'], 1.)
+    assert np.allclose(result['ks'], 0.)
+
+def test_empty_histograms():
+    reference = [np.zeros(3), np.zeros(3), np.array([1., 2., 3.])]
+    target = [np.zeros(3), np.array([1., 2., 3.]), np.zeros(3)]
+    result = Comparison.testCounts(reference, target)
+
+    assert result['p_chi2'][0] == 1. and result['p_ks'][0] == 1.
+    assert np.all(result['p_chi2'][1:] == 0.)
+    assert np.all(result['p_ks'][1:] == 0.)
+
+def test_ks_only_for_1d_histograms(tmp_path):
+    histograms = {
+        'LC_reco': Histogram([[0., 1., 2., 3.]], [5, 3, 1]),
+        'LC_reco_eta': Histogram([[1.5, 2., 3.], [0., 1., 2., 3.]], [[5, 3, 1], [1, 3, 5]])
+    }
+    for release in ['reference', 'target']:
+        openStorage(str(tmp_path / f'{release}_ntuple.json'))\
+            .write({name: histo.toDict() for name, histo in histograms.items()})
+
+    comparison = Comparison(str(tmp_path / 'reference_ntuple.json'),\
+                            str(tmp_path / 'target_ntuple.json'), str(tmp_path))
+    results = comparison.compare()
+    assert results['LC_reco']['p_ks'] == pytest.approx(1.)
+    assert results['LC_reco_eta']['ks'] is None and results['LC_reco_eta']['p_ks'] is None
+    assert results['LC_reco_eta']['p_chi2'] == pytest.approx(1.)
+    assert comparison.failed() == []
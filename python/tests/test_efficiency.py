@@ -0,0 +1,65 @@
+import awkward as ak
+import numpy as np
+import pytest
+from scipy.stats import binomtest
+from validation.DataFile import DataChunk
+from validation.DataProcessor import DataProcessor, Efficiency
+
+thresholds = np.array([0.05, 0.1, 0.2])
+
+def test_failed_and_passed_thresholds():
+    # unmatched (nan), equal to thresholds (fails them), between and above
+    score = np.array([np.nan, 0.01, 0.05, 0.1, 0.15, 0.2, 0.5])
+    n_failed, failed_edges = DataProcessor._failedThresholds(thresholds, score)
+    assert np.array_equal(n_failed, [3, 0, 1, 2, 2, 3, 3])
+    assert np.array_equal(failed_edges, [-0.5, 0.5, 1.5, 2.5, 3.5])
+
+    counts, _ = np.histogram(n_failed, bins=failed_edges)
+    passed = DataProcessor._passedThresholds(counts)
+    expected = [np.sum(score < threshold) for threshold in thresholds]
+    assert np.array_equal(passed[:len(thresholds)], expected)
+
+def test_efficiency_of_hand_built_event():
+    # 2 events, 5 sim objects: best scores 0.05, none, 0.15 | 0.01, none
+    association = ak.Array([[[0, 1], [], [1]], [[0], []]])
+    score = ak.Array([[[0.05, 0.3], [], [0.15]], [[0.01], []]])
+    energy = ak.Array([[10., 20., 30.], [40., 50.]])
+    eta = ak.Array([[1.8, 2.5, 1.9], [2.6, 2.7]])
+    chunk = DataChunk({
+        ('ticlDumper/associations;1', 'tsCLUE3D_simToReco_CP'): association,
+        ('ticlDumper/associations;1', 'tsCLUE3D_simToReco_CP_score'): score,
+        ('ticlDumper/simtrackstersCP;1', 'raw_energy'): energy,
+        ('ticlDumper/simtrackstersCP;1', 'barycenter_eta'): eta
+    }, 0, 2)
+
+    efficiency = Efficiency(thresholds=thresholds, bins={'E': [0., 100.], 'eta': [1.5, 3.]})
+    efficiency.getData(chunk)
+    data = efficiency.data
+    assert np.array_equal(data['LC_E_all_den'].counts, [5])
+    assert np.array_equal(data['LC_E_all_num_0.05'].counts, [1])
+    assert np.array_equal(data['LC_E_all_num_0.1'].counts, [2])
+    assert np.array_equal(data['LC_E_all_num_0.2'].counts, [3])
+    assert np.array_equal(data['LC_E_HD_den'].counts, [2])
+    assert np.array_equal(data['LC_E_HD_num_0.2'].counts, [2])
+    assert np.array_equal(data['LC_E_LD_num_0.2'].counts, [1])
+
+@pytest.mark.parametrize('method, scipy_method', [('wilson', 'wilson'),\
+                                                 ('clopper-pearson', 'exact')])
+def test_interval_matches_scipy(method, scipy_method):
+    numerator = np.array([0, 1, 7, 10, 10])
+    denominator = np.array([10, 10, 10, 10, 100])
+    efficiency, low, high = Efficiency.interval(numerator, denominator, method, cl=0.683)
+
+    assert np.allclose(efficiency, numerator/denominator)
+    for k, n, k_low, k_high in zip(numerator, denominator, low, high):
+        interval = binomtest(int(k), int(n)).proportion_ci(confidence_level=0.683,\
+                                                           method=scipy_method)
+        assert k_low == pytest.approx(interval.low, abs=1e-9)
+        assert k_high == pytest.approx(interval.high, abs=1e-9)
+
+def test_interval_of_empty_bins():
+    efficiency, low, high = Efficiency.interval([0, 3], [0, 3])
+    assert np.isnan(efficiency[0]) and np.isnan(low[0]) and np.isnan(high[0])
+    assert efficiency[1] == 1. and high[1] == pytest.approx(1.)
+    with pytest.raises(ValueError):
+        Efficiency.interval([1], [2], method='normal')
@@ -0,0 +1,88 @@
+import numpy as np
+from validation.Histogram import Histogram, SparseHistogram
+from validation.NTupler import NTupler
+
+rng = np.random.default_rng(0)
+x_edges = np.linspace(0, 1, 6)
+y_edges = np.linspace(-2, 2, 9)
+z_edges = np.array([-0.5, 0.5, 1.5])
+
+def randomData(n):
+    # entries out of range of x and y are kept to check under/overflow
+    return rng.uniform(-0.2, 1.2, n), rng.normal(0, 1.5, n), rng.integers(0, 2, n)
+
+def test_sparse_projection_matches_histogram2d():
+    x, y, z = randomData(1000)
+    histo = SparseHistogram([x_edges, y_edges, z_edges]).fill(x, y, z)
+
+    expected, _, _ = np.histogram2d(x, y, bins=[x_edges, y_edges])
+    assert np.array_equal(histo.project(0, 1).counts, expected)
+    expected, _, _ = np.histogram2d(y, x, bins=[y_edges, x_edges])
+    assert np.array_equal(histo.project(1, 0).counts, expected)
+
+    expected, _ = np.histogram(y[z == 1], bins=y_edges)
+    assert np.array_equal(histo.project(1, select={2: 1}).counts, expected)
+
+def test_sparse_last_bin_includes_right_edge():
+    histo = SparseHistogram([x_edges]).fill(np.array([0., 1., 1.5]))
+    assert np.array_equal(histo.project(0).counts, np.histogram([0., 1., 1.5], x_edges)[0])
+
+def test_sparse_merge_matches_single_fill():
+    x, y, z = randomData(2000)
+    merged = SparseHistogram([x_edges, y_edges, z_edges]).fill(x[:700], y[:700], z[:700])
+    merged.merge(SparseHistogram([x_edges, y_edges, z_edges]).fill(x[700:], y[700:], z[700:]))
+    single = SparseHistogram([x_edges, y_edges, z_edges]).fill(x, y, z)
+
+    assert np.array_equal(merged.index, single.index)
+    assert np.array_equal(merged.counts, single.counts)
+    expected, _ = np.histogramdd(np.stack([x, y, z], axis=-1), bins=[x_edges, y_edges, z_edges])
+    assert np.array_equal(merged.toDense().counts, expected)
+
+def test_sparse_dict_round_trip():
+    x, y, z = randomData(100)
+    histo = SparseHistogram([x_edges, y_edges, z_edges], names=['x', 'y', 'z']).fill(x, y, z)
+    restored = Histogram.fromDict(histo.toDict())
+
+    assert restored.names == ['x', 'y', 'z']
+    assert restored.hasSameEdges(histo)
+    assert np.array_equal(restored.toDense().counts, histo.toDense().counts)
+
+def test_mask_histograms_binned_in_masked_range(tmp_path):
+    n = 500
+    eta = rng.uniform(1.5, 3.0, n)
+    data = {'Tracksters_reco': eta * 10}
+    combination_data = {'Tracksters_reco_E': rng.exponential(50, n),
+                        'Tracksters_reco_ET': rng.exponential(10, n),
+                        'Tracksters_reco_eta': eta,
+                        'Tracksters_reco_HD': eta < 2.0,
+                        'Tracksters_reco_LD': eta >= 2.0}
+    ntupler = NTupler(data, combination_data, output=str(tmp_path / 'output.json'))
+    ntupler.makeHist()
+
+    for comb_key in ['HD', 'LD']:
+        masked = data['Tracksters_reco'][combination_data[f'Tracksters_reco_{comb_key}']]
+        counts, edges = np.histogram(masked, bins=10)
+        histo = ntupler.histograms[f'Tracksters_reco_{comb_key}']
+        assert np.array_equal(histo.edges[0], edges)
+        assert np.array_equal(histo.counts, counts)
+
+    counts, _, _ = np.histogram2d(eta, data['Tracksters_reco'], bins=10)
+    assert np.array_equal(ntupler.histograms['Tracksters_reco_eta'].counts, counts)
+
+def test_c_data_bins_without_masks(tmp_path):
+    n = 200
+    eta = rng.uniform(1.5, 3.0, n)
+    data = {'LC_reco': rng.uniform(0, 10, n)}
+    combination_data = {'LC_reco_E': rng.exponential(50, n),
+                        'LC_reco_ET': rng.exponential(10, n),
+                        'LC_reco_eta': eta,
+                        'LC_reco_HD': eta < 2.0,
+                        'LC_reco_LD': eta >= 2.0}
+    # bins file of Runner: no bins for masks HD and LD
+    c_data_bins = {'E': [0., 50., 1000.], 'ET': [0., 10., 500.], 'eta': [1.5, 2., 3.]}
+    ntupler = NTupler(data, combination_data, {'LC_reco': list(np.linspace(0, 10, 6))},\
+                      c_data_bins, output=str(tmp_path / 'output.json'))
+    ntupler.makeHist()
+
+    assert np.array_equal(ntupler.histograms['LC_reco_eta'].edges[0], c_data_bins['eta'])
+    assert np.sum(ntupler.histograms['LC_reco_HD'].counts) == np.sum(eta < 2.0)
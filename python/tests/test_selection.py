@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from validation.Selection import Selection
+
+arrays = {
+    'a': np.array([-3., -1., 0.5, 2., 4.]),
+    'b': np.array([1., 2., 3., 4., 5.])
+}
+
+def evaluate(expression):
+    return Selection({'result': expression}).evaluate(arrays)['result']
+
+@pytest.mark.parametrize('expression, expected', [
+    ('a + b * 2', arrays['a'] + arrays['b']*2),
+    ('(a + b) * 2', (arrays['a'] + arrays['b'])*2),
+    ('a - b - 1', (arrays['a'] - arrays['b']) - 1),
+    ('a / b / 2', (arrays['a']/arrays['b'])/2),
+    ('-a * b', (-arrays['a'])*arrays['b']),
+    ('abs(a) * 2 + 1', np.abs(arrays['a'])*2 + 1),
+    ('1e1 * .5 - a', 5. - arrays['a'])
+])
+def test_arithmetic_precedence(expression, expected):
+    assert np.allclose(evaluate(expression), expected)
+
+@pytest.mark.parametrize('expression, expected', [
+    # comparisons bind tighter than & and |, unlike in Python
+    ('a > 0 & b < 5', (arrays['a'] > 0) & (arrays['b'] < 5)),
+    ('a < 0 | b > 3 & a < 3', (arrays['a'] < 0) | ((arrays['b'] > 3) & (arrays['a'] < 3))),
+    ('~a > 0 & b > 1', (~(arrays['a'] > 0)) & (arrays['b'] > 1)),
+    ('~(a > 0 & b > 1)', ~((arrays['a'] > 0) & (arrays['b'] > 1))),
+    ('abs(a) + 1 >= b * 2', (np.abs(arrays['a']) + 1) >= (arrays['b']*2)),
+    ('a == 2 | b != 1', (arrays['a'] == 2) | (arrays['b'] != 1))
+])
+def test_logical_precedence(expression, expected):
+    assert np.array_equal(evaluate(expression), expected)
+
+@pytest.mark.parametrize('expression', [
+    'a <', '(a > 0', 'a > 0)', 'abs a', 'a $ b', 'a b', 'a < b < 2', ''
+])
+def test_parse_errors(expression):
+    with pytest.raises(ValueError):
+        Selection.compile(expression)
+
+def test_columns_and_shared_subexpressions():
+    selection = Selection({'HD': 'abs(a) < 2', 'LD': 'abs(a) >= 2', 'E': 'b'})
+    assert selection.columns() == {'a', 'b'}
+
+    results = selection.evaluate(arrays)
+    assert np.array_equal(results['HD'], ~results['LD'])
+    assert results['E'] is arrays['b']
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+from validation.Histogram import Histogram, SparseHistogram
+from validation.Storage import openStorage, convert, NPZStorage
+from validation.NTupler import NTupler
+
+rng = np.random.default_rng(0)
+
+def makeHistograms():
+    edges = np.linspace(0., 1., 6)
+    c_edges = np.array([0., 0.5, 2.])
+    sparse = SparseHistogram([c_edges, edges], names=['E', 'data'])\
+             .fill(rng.uniform(0, 2, 50), rng.uniform(0, 1, 50))
+    return {
+        'LC_reco': Histogram([edges]).fill(rng.uniform(0, 1, 100)).toDict(),
+        'LC_reco_E': Histogram([c_edges, edges]).fill(rng.uniform(0, 2, 100),\
+                                                      rng.uniform(0, 1, 100)).toDict(),
+        'LC_reco_nd': sparse.toDict(),
+        'LC_sim': Histogram([edges]).toDict(),
+        'LC_sim_nd': SparseHistogram([c_edges, edges], names=['E', 'data']).toDict()
+    }
+
+def assertSame(stored, histograms):
+    assert sorted(stored.keys()) == sorted(histograms.keys())
+    for name, histogram in histograms.items():
+        assert sorted(stored[name].keys()) == sorted(histogram.keys())
+        for key, value in histogram.items():
+            assert np.array_equal(np.asarray(stored[name][key]), np.asarray(value)), (name, key)
+
+def test_npz_round_trip_is_memory_mapped(tmp_path):
+    histograms = makeHistograms()
+    path = str(tmp_path / 'multiplicity_ntuple.npz')
+    openStorage(path).write(histograms)
+
+    storage = openStorage(path)
+    assert isinstance(storage, NPZStorage)
+    assertSame(storage.read(), histograms)
+    assert isinstance(storage['LC_reco']['data'], np.memmap)
+    assert isinstance(storage['LC_reco_E']['data'], np.memmap)
+    assert storage['LC_reco_E']['data'].shape == (2, 5)
+    # empty arrays can not be memory-mapped
+    assert storage['LC_sim_nd']['sparse_index'].shape == (0,)
+
+    restored = Histogram.fromDict(storage['LC_reco_nd'])
+    assert restored.names == ['E', 'data']
+    assert np.array_equal(restored.toDense().counts,\
+                          Histogram.fromDict(histograms['LC_reco_nd']).toDense().counts)
+
+def test_npz_without_mmap(tmp_path):
+    histograms = makeHistograms()
+    path = str(tmp_path / 'multiplicity_ntuple.npz')
+    openStorage(path).write(histograms)
+
+    storage = NPZStorage(path, mmap=False)
+    assertSame(storage.read(), histograms)
+    assert not isinstance(storage['LC_reco']['data'], np.memmap)
+
+def test_convert_npz_to_json(tmp_path):
+    histograms = makeHistograms()
+    npz_path = str(tmp_path / 'multiplicity_ntuple.npz')
+    json_path = str(tmp_path / 'multiplicity_ntuple.json')
+    openStorage(npz_path).write(histograms)
+    convert(npz_path, json_path)
+
+    assertSame(openStorage(json_path).read(), histograms)
+
+def test_write_replaces_file(tmp_path):
+    path = str(tmp_path / 'multiplicity_ntuple.npz')
+    storage = openStorage(path)
+    storage.write(makeHistograms())
+    assert 'LC_reco' in storage
+    storage.write({'LC_sim': Histogram([[0., 1.]], [3]).toDict()})
+    assert list(storage) == ['LC_sim']
+    assert list(tmp_path.iterdir()) == [tmp_path / 'multiplicity_ntuple.npz']
+
+def test_unknown_format(tmp_path):
+    with pytest.raises(ValueError):
+        openStorage(str(tmp_path / 'output.root'))
+
+def test_append_leaves_only_output(tmp_path, monkeypatch):
+    monkeypatch.setenv('TICL_VALIDATION_CACHE', str(tmp_path / 'cache'))
+    output = tmp_path / 'out' / 'LC_ntuple.json'
+    output.parent.mkdir()
+    histograms = makeHistograms()
+    ntupler = NTupler({}, {}, output=str(output), mode='a')
+    ntupler._writeOutput({'LC_reco': histograms['LC_reco']}, append=True)
+    ntupler._writeOutput({'LC_sim': histograms['LC_sim']}, append=True)
+
+    assert [path.name for path in output.parent.iterdir()] == ['LC_ntuple.json']
+    assert len(list((tmp_path / 'cache' / 'locks').iterdir())) == 1
+    assert set(openStorage(str(output)).read()) == {'LC_reco', 'LC_sim'}
@@ -0,0 +1,274 @@
+# Comparison of NTuples of two releases (e.g. 14_2_0_pre1 against a reference).
+# Run from python/ directory:
+#
+#       python -m validation.Comparison reference/multiplicity_ntuple.json \
+#           target/multiplicity_ntuple.json --output comparison --threshold 0.05
+#
+# Compatibility of each pair of histograms with the same name is tested on
+# binned counts (2D and N-dimensional histograms are flattened):
+#       chi2 - chi2 test of two unweighted histograms (shapes are compared, so
+#              different numbers of events are allowed). ndf is the number of
+#              non-empty bins - 1
+#       ks   - Kolmogorov-Smirnov distance of cumulative distributions of
+#              counts, p-value with effective number of entries N1*N2/(N1 + N2).
+#              Only for 1D histograms: cumulative distribution of flattened
+#              counts depends on the order of bins, so 2D and N-dimensional
+#              histograms are tested with chi2 only (ks and p_ks are None)
+# All the histograms are tested at once: counts are padded to the same number
+# of bins and the statistics are computed on 2D arrays.
+#
+# A histogram fails if p-value of any of tests is lower than threshold, if it
+# is empty in only one of the files, or if it has different bin edges in the
+# two files. makePlots() renders only the
+# failing histograms as overlay (normalized to unit area) and ratio plots with
+# the style of Plotter: 1D histograms as one plot, 2D histograms as one plot
+# per c_data bin (as unrolledHist()). N-dimensional histograms are rendered as
+# their 2D (1D for masks) views, as in Plotter.
+import argparse
+import json
+import numpy as np
+from typing import Dict, List, Tuple
+import matplotlib.pyplot as plt
+import mplhep as hep
+from .Plotter import Plotter
+from .Histogram import Histogram
+from .Storage import openStorage
+from .Profiler import stage
+
+class Comparison(Plotter):
+    tests = ['chi2', 'ks']
+
+    def __init__(self, reference: str, target: str, output: str,\
+                 labels: Tuple[str, str] = ('reference', 'target')):
+        super().__init__(target, output)
+        self.reference = reference
+        self.reference_file = openStorage(reference)
+        self.labels = labels
+        self.results = None
+        self.missing = None
+
+    # Returns a dictionary {histogram name: result of tests}
+    def compare(self, threshold: float = 0.05, tests: List[str] = ['chi2', 'ks']):
+        for test in tests:
+            if test not in Comparison.tests:
+                raise KeyError(f'test = {test} is unavailable. Available tests: {Comparison.tests}')
+
+        names = [name for name in self.file if name in self.reference_file]
+        self.missing = sorted(set(self.file) ^ set(self.reference_file))
+
+        reference_histos = {name: Histogram.fromDict(self.reference_file[name]) for name in names}
+        target_histos = {name: Histogram.fromDict(self.file[name]) for name in names}
+        same_edges = [name for name in names\
+                      if reference_histos[name].hasSameEdges(target_histos[name])]
+
+        with stage('Comparison.compare'):
+            statistics = Comparison.testCounts(\
+                [Comparison._flatCounts(reference_histos[name]) for name in same_edges],\
+                [Comparison._flatCounts(target_histos[name]) for name in same_edges])
+
+        self.results = {}
+        for name in names:
+            if name not in same_edges:
+                self.results[name] = {'same_edges': False, 'failed': True}
+        for i, name in enumerate(same_edges):
+            result = {key: float(values[i]) for key, values in statistics.items()}
+            result['ndf'] = int(result['ndf'])
+            if target_histos[name].ndim > 1:
+                result['ks'], result['p_ks'] = None, None
+            p_values = [result[f'p_{test}'] for test in tests if result[f'p_{test}'] is not None]
+            result['same_edges'] = True
+            result['failed'] = bool(any(p_value < threshold for p_value in p_values))
+            self.results[name] = result
+
+        return self.results
+
+    def failed(self):
+        return [name for name, result in self.results.items() if result['failed']]
+
+    def saveReport(self, output: str = 'comparison.json'):
+        report = {
+            'reference': self.reference,
+            'target': self.input,
+            'missing': self.missing,
+            'failed': self.failed(),
+            'results': self.results
+        }
+        with open(output, 'w') as file:
+            json.dump(report, file, indent=4)
+
+    # Only failing histograms are rendered
+    def makePlots(self):
+        for hist_name in self.failed():
+            with stage('Comparison.plotHist'):
+                self.compareHist(hist_name)
+        self.closeFigure()
+
+    def compareHist(self, hist_name: str):
+        reference, target = self.reference_file[hist_name], self.file[hist_name]
+        if Histogram.isMultiDim(target) or Histogram.isMultiDim(reference):
+            reference_histo, target_histo = Histogram.fromDict(reference), Histogram.fromDict(target)
+            if reference_histo.ndim != target_histo.ndim:
+                return 0
+            # views of each axis are compared (see Plotter._view())
+            for axis in range(target_histo.ndim - 1):
+                view_name, target_view = self._view(hist_name, target, axis)
+                _, reference_view = self._view(hist_name, reference, axis)
+                self._compareView(view_name, reference_view, target_view, hist_name)
+            return 0
+
+        self._compareView(hist_name, reference, target)
+        return 0
+
+    # result_name is the name of tested histogram (hist_name if None)
+    def _compareView(self, hist_name: str, reference: Dict[str, List], target: Dict[str, List],\
+                     result_name: str = None):
+        if np.ndim(target['data']) != np.ndim(reference['data']):
+            return 0
+
+        if np.ndim(target['data']) == 1:
+            self.overlayHist(hist_name, reference, target, result_name=result_name)
+        else:
+            comb_var = self._combVar(hist_name)
+            for bin in range(len(target['data'])):
+                comb_bin_min = np.round(target['c_data_bin_edges'][bin], 2)
+                comb_bin_max = np.round(target['c_data_bin_edges'][bin + 1], 2)
+                self.overlayHist(hist_name, reference, target, comb_bin_min, comb_bin_max,\
+                                 comb_var, bin, result_name)
+        return 0
+
+    def overlayHist(self, hist_name: str, reference: Dict[str, List], target: Dict[str, List],\
+                    comb_bin_min: float = None, comb_bin_max: float = None,\
+                    comb_var: str = None, bin_num: int = None, result_name: str = None):
+        hists = []
+        for hist in [reference, target]:
+            counts = np.asarray(hist['data'], dtype=np.float64)
+            if bin_num is not None:
+                counts = counts[bin_num]
+            total = np.sum(counts)
+            hists.append((counts/total if total > 0 else counts, np.asarray(hist['data_bin_edges'])))
+
+        fig, (ax, ax_ratio) = self._getRatioFigure()
+        for (counts, edges), label in zip(hists, self.labels):
+            ax.stairs(counts, edges, label=label)
+        hep.cms.label('Internal', loc=0, com=None, ax=ax)
+
+        if result_name is None:
+            result_name = hist_name
+        result = self.results.get(result_name, {}) if self.results is not None else {}
+        title = self._setLabel(comb_bin_min, comb_bin_max, comb_var)
+        if result.get('same_edges', False):
+            title += f"\n$p_{{\\chi^2}}$ = {result['p_chi2']:.3g}"
+            if result['p_ks'] is not None:
+                title += f", $p_{{KS}}$ = {result['p_ks']:.3g}"
+
+            (reference_counts, edges), (target_counts, _) = hists
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ratio = target_counts/reference_counts
+            ax_ratio.stairs(np.where(np.isfinite(ratio), ratio, np.nan), edges)
+            ax_ratio.axhline(1., color='gray', linestyle='--')
+        ax.legend(title=title)
+
+        ax.set_ylabel('Normalized counts')
+        ax_ratio.set_ylabel(f'{self.labels[1]}/{self.labels[0]}', fontsize='small')
+        ax_ratio.set_xlabel(self.hist1D_x_labels.get(self.prefix, {})\
+                            .get(hist_name.split('_')[0], hist_name))
+
+        if bin_num is None:
+            path = f'{self.output}/{self._plotName(hist_name)}_comparison.svg'
+        else:
+            path = f'{self.output}/{self._plotName(hist_name)}_{bin_num}_comparison.svg'
+        with stage('Plotter.savefig'):
+            fig.savefig(path)
+
+    # reference and target are lists of 1D arrays of counts (arrays of the same
+    # index have the same length). Returns a dictionary of arrays: chi2, ndf,
+    # p_chi2, ks, p_ks
+    @staticmethod
+    def testCounts(reference: List[np.ndarray], target: List[np.ndarray]):
+        from scipy.special import kolmogorov
+        from scipy.stats import chi2
+
+        n_bins = max([len(counts) for counts in reference], default=0)
+        r = Comparison._pad(reference, n_bins)
+        t = Comparison._pad(target, n_bins)
+        r_total = np.sum(r, axis=1, keepdims=True)
+        t_total = np.sum(t, axis=1, keepdims=True)
+
+        # chi2 test of two unweighted histograms
+        non_empty = (r + t) > 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            terms = (t_total*r - r_total*t)**2/(r + t)
+            chi2_values = np.sum(np.where(non_empty, terms, 0.), axis=1)/(r_total*t_total)[:, 0]
+        ndf = np.sum(non_empty, axis=1) - 1
+        p_chi2 = np.where(ndf > 0, chi2.sf(chi2_values, np.maximum(ndf, 1)), 1.)
+
+        # KS distance of cumulative distributions (padding does not change them)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r_cdf = np.cumsum(r, axis=1)/r_total
+            t_cdf = np.cumsum(t, axis=1)/t_total
+            ks = np.max(np.abs(r_cdf - t_cdf), axis=1, initial=0.)
+            n_effective = (r_total*t_total/(r_total + t_total))[:, 0]
+        p_ks = kolmogorov(np.sqrt(n_effective)*ks)
+
+        # two empty histograms are compatible, an empty histogram is never
+        # compatible with a filled one (histogram is no longer or newly filled)
+        r_empty, t_empty = r_total[:, 0] == 0, t_total[:, 0] == 0
+        empty = r_empty & t_empty
+        one_empty = r_empty ^ t_empty
+        return {
+            'chi2': np.select([empty, one_empty], [0., np.inf], chi2_values),
+            'ndf': np.where(empty | one_empty, 0, ndf),
+            'p_chi2': np.select([empty, one_empty], [1., 0.], p_chi2),
+            'ks': np.select([empty, one_empty], [0., 1.], ks),
+            'p_ks': np.select([empty, one_empty], [1., 0.], p_ks)
+        }
+
+    @staticmethod
+    def _flatCounts(histo):
+        if hasattr(histo, 'toDense'):
+            histo = histo.toDense()
+        return np.ravel(histo.counts).astype(np.float64)
+
+    @staticmethod
+    def _pad(counts: List[np.ndarray], n_bins: int):
+        padded = np.zeros((len(counts), n_bins), dtype=np.float64)
+        for i, histo_counts in enumerate(counts):
+            padded[i, :len(histo_counts)] = histo_counts
+        return padded
+
+    # Returns the figure of the Plotter with main and ratio axes
+    def _getRatioFigure(self):
+        if self.figure is None:
+            self.figure = plt.figure()
+        else:
+            self.figure.clear()
+        ax, ax_ratio = self.figure.subplots(2, 1, sharex=True,\
+                                            gridspec_kw={'height_ratios': [3, 1]})
+        return self.figure, (ax, ax_ratio)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare NTuples of two releases')
+    parser.add_argument('reference', help='NTuple of the reference release')
+    parser.add_argument('target', help='NTuple of the tested release')
+    parser.add_argument('--output', default='comparison', help='directory of plots')
+    parser.add_argument('--labels', nargs=2, default=['reference', 'target'])
+    parser.add_argument('--threshold', type=float, default=0.05)
+    parser.add_argument('--tests', nargs='+', default=['chi2', 'ks'], choices=Comparison.tests)
+    parser.add_argument('--report', default=None, help='.json file with results of tests')
+    args = parser.parse_args(argv)
+
+    comparison = Comparison(args.reference, args.target, args.output, tuple(args.labels))
+    comparison.compare(args.threshold, args.tests)
+    failed = comparison.failed()
+    print(f'{len(failed)} of {len(comparison.results)} histograms failed')
+    for hist_name in failed:
+        print(f'    {hist_name}')
+    if len(comparison.missing) > 0:
+        print(f'missing in one of the files: {comparison.missing}')
+
+    comparison.makePlots()
+    if args.report is not None:
+        comparison.saveReport(args.report)
+
+if __name__ == '__main__':
+    main()
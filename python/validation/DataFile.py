@@ -1,6 +1,8 @@
 import uproot as ur
 import awkward as ak
 import numpy as np
+from collections import OrderedDict
+from .Profiler import stage, count, addBytes, enabled
 
 # This class allows to open desired data of ticl_dumper.root files.
 # Methods starting from underscore are meant to be used ONLY inside other methods.
@@ -13,55 +15,209 @@ import numpy as np
 #
 # Use getBranchKeys() if you want to know all the arrays inside a given branch.
 # Use openArray() to open desired array (awkward).
+# Use openArrays() to open several arrays at once. It takes a list of
+# (branch_name, key) pairs and reads all the keys of one branch with a single
+# uproot arrays() call.
+#
+# Every opened array is kept in a LRU cache bounded by cache_size (in bytes),
+# so that repeated requests of the same array do not touch the file again.
+# cache_size=0 disables caching. Use clearCache() to release the memory.
+# Arrays needed only once (e.g. large vertices_* arrays) can be opened with
+# cache=False, then they are neither taken from nor put into the cache.
+#
+# Use iterate() to stream a list of (branch_name, key) pairs in chunks of
+# step_size events (int) or of a given memory size (str, e.g. '100 MB', see
+# stepEntries()). All the branches are cut at the same event boundaries, so
+# each chunk is a DataChunk object with aligned arrays. DataChunk has the same
+# openArray() and openArrays() methods as DataFile, so it can be given to a
+# processor instead of the whole file.
+#
+# disk_cache is an optional DiskCache object. Processors store there arrays
+# derived from the file (see DataProcessor.loadCache()), so that repeated runs
+# over the same file do not read it again.
+#
+# Reads are instrumented by Profiler (see Profiler.py): time of reads, number of
+# openArray() calls and in-memory size of arrays read from each branch.
+#
+# Opening a DataFile reads only metadata: number of events is taken from the
+# TTree header and keys of each branch are listed once, when the branch is
+# used for the first time. Branch names may be given with or without cycle
+# number (e.g. 'ticlDumper/associations' or 'ticlDumper/associations;1').
+
+TREE_CLASSES = {'TTree', 'ROOT::RNTuple'}
 
 class DataFile:
-    def __init__(self, filepath):
+    def __init__(self, filepath, cache_size=2**30, disk_cache=None):
         self.filepath = filepath
+        self.disk_cache = disk_cache
         self.file = ur.open(filepath)
         self.nevents = None
         self.branches = self.file.keys()
+        self.classnames = self.file.classnames()
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_nbytes = 0
+        self._branch_names = set(self.branches) | {branch.split(';')[0] for branch in self.branches}
+        self._branch_keys = {}
+        self._branch_key_sets = {}
         self._nEvents()
 
     def getBranchKeys(self, branch_name=''):
         self._correctBranchName(branch_name)
-        return self.file[branch_name].keys()
+        if branch_name not in self._branch_keys:
+            self._branch_keys[branch_name] = self.file[branch_name].keys()
+            self._branch_key_sets[branch_name] = set(self._branch_keys[branch_name])
+        return list(self._branch_keys[branch_name])
         
-    def openArray(self, branch_name='', key=''):
-        self._correctBranchName(branch_name)
-        self._correctKey(branch_name, key)
+    def openArray(self, branch_name='', key='', cache=True):
+        count('DataFile.openArray')
+        return self.openArrays([(branch_name, key)], cache)[(branch_name, key)]
+
+    # columns is a list of (branch_name, key) pairs. Returns a dictionary
+    # {(branch_name, key): array}
+    def openArrays(self, columns=[], cache=True):
+        arrays = {}
+        keys_to_read = {}
+        for branch_name, key in columns:
+            self._correctBranchName(branch_name)
+            self._correctKey(branch_name, key)
+
+            if cache and (branch_name, key) in self._cache:
+                self._cache.move_to_end((branch_name, key))
+                arrays[(branch_name, key)] = self._cache[(branch_name, key)]
+            elif key not in keys_to_read.setdefault(branch_name, []):
+                keys_to_read[branch_name].append(key)
+
+        # one read per branch for all the missing keys
+        for branch_name, keys in keys_to_read.items():
+            if len(keys) == 0:
+                continue
+            with stage('DataFile.read'):
+                branch_arrays = self.file[branch_name].arrays(keys)
+            if enabled():
+                addBytes(branch_name, sum(branch_arrays[key].nbytes for key in keys))
+            for key in keys:
+                arrays[(branch_name, key)] = branch_arrays[key]
+                if cache:
+                    self._cacheArray((branch_name, key), branch_arrays[key])
+
+        return arrays
+
+    def iterate(self, columns=[], step_size=100000):
+        keys_to_read = {}
+        for branch_name, key in columns:
+            self._correctBranchName(branch_name)
+            self._correctKey(branch_name, key)
+            if key not in keys_to_read.setdefault(branch_name, []):
+                keys_to_read[branch_name].append(key)
+
+        # memory size is converted to number of events, so that all the
+        # branches are split in the same way
+        step_size = self.stepEntries(columns, step_size)
+
+        iterators = [self.file[branch_name].iterate(keys, step_size=step_size)\
+                     for branch_name, keys in keys_to_read.items()]
+
+        entry_start = 0
+        chunks = zip(*iterators)
+        while True:
+            with stage('DataFile.iterate'):
+                branch_chunks = next(chunks, None)
+            if branch_chunks is None:
+                break
 
-        return self.file[branch_name][key].array()
+            arrays = {}
+            for branch_name, branch_chunk in zip(keys_to_read.keys(), branch_chunks):
+                for key in keys_to_read[branch_name]:
+                    arrays[(branch_name, key)] = branch_chunk[key]
+                    if enabled():
+                        addBytes(branch_name, branch_chunk[key].nbytes)
+
+            entry_stop = entry_start + len(branch_chunks[0])
+            yield DataChunk(arrays, entry_start, entry_stop, self.filepath)
+            entry_start = entry_stop
+
+    # Converts step_size given as memory size (str, e.g. '100 MB') to the
+    # number of events such that a chunk of each branch of columns fits into it
+    def stepEntries(self, columns=[], step_size=100000):
+        if type(step_size) != str:
+            return step_size
+
+        keys_to_read = {}
+        for branch_name, key in columns:
+            if key not in keys_to_read.setdefault(branch_name, []):
+                keys_to_read[branch_name].append(key)
+
+        step_entries = min(self.file[branch_name].num_entries_for(step_size, keys)\
+                           for branch_name, keys in keys_to_read.items())
+        return max(step_entries, 1)
+
+    def clearCache(self):
+        self._cache.clear()
+        self._cache_nbytes = 0
+        return 0
+
+    # Put array into the cache and evict the least recently used arrays
+    # until the cache fits into self.cache_size
+    def _cacheArray(self, column, array):
+        nbytes = array.nbytes
+        if nbytes > self.cache_size:
+            return 0
+
+        self._cache[column] = array
+        self._cache_nbytes += nbytes
+        while self._cache_nbytes > self.cache_size:
+            _, evicted = self._cache.popitem(last=False)
+            self._cache_nbytes -= evicted.nbytes
+        return 0
     
     # Check if a given branch_name is available
     def _correctBranchName(self, branch_name=''):
-        if branch_name not in self.branches:
+        if branch_name not in self._branch_names:
             raise NameError(f'branch name = {branch_name} is unavailable in data'\
                             + f' file. \n Available branch names: \n {self.branches}')
         return 0
     
     # Check if a given key is available for a given branch_name
     def _correctKey(self, branch_name='', key=''):
-        if key not in self.getBranchKeys(branch_name):
-            keys = self.getBranchKeys(branch_name)
+        if branch_name not in self._branch_key_sets:
+            self.getBranchKeys(branch_name)
+        if key not in self._branch_key_sets[branch_name]:
+            keys = self._branch_keys[branch_name]
             raise KeyError(f'key = {key} is unavailable in branch {branch_name}.'\
                            + f'\n Available keys: \n {keys}')
         return 0
     
     # Compute number of events in DataFile. Called automatically during
-    # initialization
+    # initialization. Only the header of the first tree is read.
     def _nEvents(self):
         if self.nevents is None:
-            branch_name = self._isLeaf(self.branches)
-            key = self._isLeaf(self.getBranchKeys(branch_name))
-            n_events = len(self.openArray(branch_name, key))
-            self.nevents = n_events
+            trees = [name for name, classname in self.classnames.items()\
+                     if classname in TREE_CLASSES]
+            if len(trees) == 0:
+                raise NameError(f'there are no trees in {self.filepath}')
+            self.nevents = self.file[trees[0]].num_entries
 
         return self.nevents
-    
-    # returns a leaf of a tree to compute number of events
-    def _isLeaf(self, l=[]):
-        for element in l:
-            bool_map = [element.split(';')[0] in el for el in l]
-            if sum(bool_map) == 1:
-                break
-        return element
\ No newline at end of file
+
+# A chunk of events produced by DataFile.iterate() (or arrays of the whole file
+# read by Planner). It holds only the requested arrays for events in
+# [entry_start, entry_stop). filepath is the path of the original file.
+class DataChunk:
+    def __init__(self, arrays, entry_start, entry_stop, filepath=None):
+        self.arrays = arrays
+        self.filepath = filepath
+        self.entry_start = entry_start
+        self.entry_stop = entry_stop
+        self.nevents = entry_stop - entry_start
+
+    # cache argument is kept for compatibility with DataFile. Arrays of chunk
+    # are already in memory
+    def openArray(self, branch_name='', key='', cache=True):
+        if (branch_name, key) not in self.arrays:
+            raise KeyError(f'key = {key} of branch {branch_name} is not loaded'\
+                           + f' in chunk. \n Loaded arrays: \n {list(self.arrays)}')
+        return self.arrays[(branch_name, key)]
+
+    def openArrays(self, columns=[], cache=True):
+        return {column: self.openArray(*column) for column in columns}
@@ -1,5 +1,13 @@
+import os
+import re
+import json
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 import awkward as ak
+from .Selection import Selection
+from .Histogram import Histogram
+from .NTupler import NTupler
+from .Profiler import stage, runProfiled, mergeTrace
 
 # This class processes given data. Methods starting from underscore are not
 # supposed to run by user.
@@ -10,48 +18,225 @@ import awkward as ak
 #
 # zToIDMap() defines a map from z-coorinates to layer ids. It is an array of the
 # following form: [max_coordinate_id=1, max_coordinate_id=2, ...]
+# The map depends only on detector geometry (e.g. D110), so it is stored in
+# DataProcessor.map_dir and reused by other processors and files of the same
+# geometry. The geometry is taken from the file path (e.g.
+# .../photons_D110_E_5_30/...) unless it is given explicitly.
+#
+# zToLayerID() converts (possibly jagged) arrays of z-coordinates to layer ids
+# using the map.
 #
 # Starting from 12/11/2024, DataProcessor class has subclasses for each type of
 # plot, required to extract data.
 #
 # Multiplicity(DataProcessor) extracts multiplicity data.
+#
+# Each processor lists the (branch_name, key) pairs it reads in columns(), so
+# that the arrays of several processors can be read together (see Planner).
+# Multiplicity, Combination and Association can store their data in an opt-in
+# disk cache of DataFile (see DiskCache), so that the next getData() for the
+# same file and configuration loads memory-mapped arrays instead of reading it.
+#
+# chunkData() returns data of a processor computed for a given chunk of events
+# (or any object with openArray() and openArrays() methods, e.g. DataChunk)
+# without touching self.data.
+#
+# Multiplicity and its subclasses can also process a file chunk by chunk with
+# iterData(), which yields self.data computed for each chunk of events. Only
+# the arrays listed in columns() are read.
+#
+# Association(DataProcessor) loads a sim-to-reco (or reco-to-sim) association
+# and finds the best match of each source object. Use gather() to get any reco
+# or sim quantity for each source object through the best match.
+#
+# Efficiency(DataProcessor) produces numerator and denominator histograms of
+# association efficiency for several score thresholds and eta regions.
+#
+# Response(DataProcessor) produces energy response histograms in bins of
+# generated energy and fits them with Cruijff function in parallel.
+#
+# EventDisplacement(DataProcessor) computes displacement of the centroid of
+# each layer of reco tracksters from the axis of the closest sim trackster.
+#
+# PCAResolution(DataProcessor) fills N-dimensional histograms of the angle
+# between PCA axes of reco tracksters and of their sim tracksters.
 
 class DataProcessor:
+    map_dir = os.environ.get('TICL_VALIDATION_CACHE',\
+                             os.path.join(os.path.expanduser('~'), '.cache', 'ticl_validation'))
+
+    # arrays of clusters used to compute zToIDMap()
+    map_columns = [('ticlDumper/clusters;1', 'position_z'),\
+                   ('ticlDumper/clusters;1', 'cluster_layer_id')]
+
     def __init__(self):
         self.maxID = None
         self.zToID = None
 
+    # Columns (branch_name, key) read by the processor
+    def columns(self):
+        return []
+
+    # Loads self.data from the disk cache of data (see DiskCache). Returns True
+    # if it is found
+    def loadCache(self, data):
+        disk_cache = getattr(data, 'disk_cache', None)
+        if disk_cache is None:
+            return False
+
+        arrays = disk_cache.load(disk_cache.key(data.filepath, self._cacheConfig()))
+        if arrays is None:
+            return False
+        self.data = arrays
+        return True
+
+    # Only flat numpy arrays are stored in the disk cache
+    def saveCache(self, data):
+        disk_cache = getattr(data, 'disk_cache', None)
+        if disk_cache is None or\
+           not all(isinstance(array, np.ndarray) for array in self.data.values()):
+            return 0
+
+        disk_cache.save(disk_cache.key(data.filepath, self._cacheConfig()), self.data)
+        return 0
+
+    def chunkData(self, chunk):
+        full_data = self.data
+        with stage(f'{type(self).__name__}.chunkData'):
+            self._getData(chunk)
+        chunk_data, self.data = self.data, full_data
+        return chunk_data
+
     # data is a DataFile object   
-    def zToIDMap(self, data):
-        # Initialize self.maxID. It is done only while primary call the function
-        # for a given object
-        self._maxLayerID(data)
+    def zToIDMap(self, data, geometry=None):
+        if geometry is None:
+            geometry = DataProcessor._findGeometry(data.filepath)
 
         # Initialize self.zToID if it isn't
+        if self.zToID is None and geometry is not None:
+            self._loadMap(geometry)
+
         if self.zToID is None:
-            cluster_z = ak.flatten(np.abs(data.openArray('ticlDumper/clusters;1',\
-                                                         'position_z')))
-            cluster_id = ak.flatten(data.openArray('ticlDumper/clusters;1',\
-                                                   'cluster_layer_id'))
-            
-            layer_id_list = []
-            for layer in range(1, self.maxID):
-                max_for_layer = np.max(cluster_z[cluster_id == layer])
-                layer_id_list.append(max_for_layer)
+            arrays = data.openArrays(DataProcessor.map_columns)
+            cluster_z = ak.to_numpy(ak.flatten(np.abs(arrays[DataProcessor.map_columns[0]])))
+            cluster_id = ak.to_numpy(ak.flatten(arrays[DataProcessor.map_columns[1]]))
 
-            self.zToID = np.array(layer_id_list)
+            # max z of each layer in one pass: clusters are sorted by layer id
+            # and reduced in groups of the same layer id
+            order = np.argsort(cluster_id, kind='stable')
+            layers, starts = np.unique(cluster_id[order], return_index=True)
+            max_for_layers = np.maximum.reduceat(cluster_z[order], starts)
+
+            self.maxID = np.max(layers)
+            layer_ids = np.arange(1, self.maxID)
+            missing_layers = np.setdiff1d(layer_ids, layers)
+            if len(missing_layers) > 0:
+                raise ValueError(f'there are no clusters in layers {missing_layers}')
+
+            self.zToID = max_for_layers[np.searchsorted(layers, layer_ids)]
+
+            if geometry is not None:
+                self._saveMap(geometry)
 
         return self.zToID
 
+    # z is a numpy or awkward (possibly jagged) array. Layer L contains
+    # z-coordinates in (zToID[L-2], zToID[L-1]]
+    def zToLayerID(self, z, data=None):
+        if self.zToID is None:
+            if data is None:
+                raise ValueError('z to layer id map is not initialized. Call'\
+                                 + ' zToIDMap() or give a DataFile object')
+            self.zToIDMap(data)
+
+        if isinstance(z, ak.Array) and z.ndim > 1:
+            counts = ak.num(z, axis=1)
+            return ak.unflatten(self.zToLayerID(ak.flatten(z, axis=1)), counts)
+
+        z = np.abs(np.asarray(z))
+        return np.searchsorted(self.zToID, z, side='left') + 1
+
     def _maxLayerID(self, data):
         if self.maxID is None:
-            max_value = 0
-
-            layer_id_array = ak.flatten(data.openArray('ticlDumper/clusters;1', \
-                                                       'cluster_layer_id'))
-            self.maxID = np.max(layer_id_array)
+            self.zToIDMap(data)
         
         return 0
+
+    def _loadMap(self, geometry):
+        path = os.path.join(DataProcessor.map_dir, f'zToID_{geometry}.npy')
+        if os.path.exists(path):
+            self.zToID = np.load(path)
+            self.maxID = len(self.zToID) + 1
+        return 0
+
+    def _saveMap(self, geometry):
+        os.makedirs(DataProcessor.map_dir, exist_ok=True)
+        path = os.path.join(DataProcessor.map_dir, f'zToID_{geometry}.npy')
+        # temporary file + rename, so that parallel jobs never read half of map
+        tmp_path = f'{path}.{os.getpid()}.tmp.npy'
+        np.save(tmp_path, self.zToID)
+        os.replace(tmp_path, path)
+        return 0
+
+    # Everything which changes self.data has to be a part of the key of cache
+    def _cacheConfig(self):
+        return (type(self).__name__, self.config)
+
+    # Bin edges of values: bins is either number of bins between min and max
+    # of finite values ('log' or 'lin' spaced according to binning_opt) or bin
+    # edges
+    @staticmethod
+    def _binEdges(bins, values, binning_opt='lin'):
+        if type(bins) != int:
+            return np.asarray(bins, dtype=np.float64)
+
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return np.linspace(0., 1., bins + 1)
+        if binning_opt == 'log':
+            return np.geomspace(np.min(values), np.max(values), bins + 1)
+        return np.linspace(np.min(values), np.max(values), bins + 1)
+
+    # Number of thresholds (sorted) failed by each object with given score
+    # (objects without score fail all of them): it passes all the thresholds
+    # starting from this index. Returns it and bin edges of a Histogram axis
+    # of it, so that all the thresholds are filled at once
+    @staticmethod
+    def _failedThresholds(thresholds, score):
+        score = np.where(np.isnan(score), np.inf, score)
+        n_failed = np.searchsorted(thresholds, score, side='right')
+        failed_edges = np.arange(len(thresholds) + 2) - 0.5
+        return n_failed, failed_edges
+
+    # counts[i] (first axis) is number of objects which failed exactly i
+    # thresholds. Returns numbers of objects passing each threshold
+    @staticmethod
+    def _passedThresholds(counts):
+        return np.cumsum(counts, axis=0)
+
+    # Writes dictionary of Histogram objects to output (see NTupler)
+    @staticmethod
+    def _saveHistograms(histograms, output):
+        ntupler = NTupler(None, None, output=output)
+        for histo_key, histo in histograms.items():
+            ntupler.addHisto(histo_key, histo)
+        ntupler.saveHistos()
+        return ntupler
+
+    # True if zToIDMap() of the geometry is already stored in map_dir
+    @staticmethod
+    def hasMap(geometry):
+        if geometry is None:
+            return False
+        return os.path.exists(os.path.join(DataProcessor.map_dir, f'zToID_{geometry}.npy'))
+
+    # Returns detector geometry (e.g. 'D110') from the path of a file or None
+    @staticmethod
+    def _findGeometry(filepath):
+        match = re.search(r'_(D\d+)(?=[_/])', str(filepath))
+        if match is None:
+            return None
+        return match.group(1)
     
 class Multiplicity(DataProcessor):
     def __init__(self):
@@ -79,36 +264,60 @@ class Multiplicity(DataProcessor):
     
 
     def getData(self, data):
-        if self.data is None:
-            self._getData(data)
+        if self.data is None and not self.loadCache(data):
+            with stage(f'{type(self).__name__}.getData'):
+                self._getData(data)
+            self.saveCache(data)
 
         return 0
     
+    # data is a DataFile object. step_size is passed to DataFile.iterate()
+    def iterData(self, data, step_size=100000):
+        # self.data of the whole file (if any) is kept untouched
+        for chunk in data.iterate(self.columns(), step_size):
+            yield self.chunkData(chunk)
+
+    def columns(self):
+        columns = []
+        for options in self.config.values():
+            for option in options.values():
+                columns.append((option, 'vertices_x'))
+        return columns
+
     def _getData(self, data):
 
         data_dict = {}
         for key, options in self.config.items():
             for option_key, option in options.items():
+                # vertices_x is read once and not cached: only its
+                # offsets are needed
+                raw_data = data.openArray(option, 'vertices_x', cache=False)
                 data_dict[f'{key}_{option_key}'] = \
-                    Multiplicity._transformData(data, option)
+                    Multiplicity._transformData(raw_data)
             
         self.data = data_dict
         return 0
     
+    # Number of vertices in each trackster. raw_data is an array of shape
+    # (events, tracksters, vertices). ak.num uses only offsets of the inner
+    # lists, so vertex values are not touched.
     @staticmethod
-    def _transformData(data, branch=''):
-        raw_data = data.openArray(branch, 'vertices_x')
-        flattened_data = ak.flatten(raw_data)
-        data = np.array([len(trackster) for trackster in flattened_data])
+    def _transformData(raw_data):
+        n_vertices = ak.num(raw_data, axis=2)
+        data = ak.to_numpy(ak.flatten(n_vertices))
 
         return data
         
 
     
 class Combination(Multiplicity):
+    # combination_config values are expressions of keys of each branch (see
+    # Selection.py), e.g. 'raw_energy' or 'abs(barycenter_eta) < 2.02'. They are
+    # compiled once in _makeConfig().
     def __init__(self):
         self.data = None
         self.config = None
+        self.selection = None
         self.rs_config = {
             'LC': {
                 'reco': 'ticlDumper/trackstersCLUE3DHigh;1',
@@ -135,50 +344,779 @@ class Combination(Multiplicity):
             for opt_key, opt_dict in self.rs_config.items():
                 opt_dict.update(self.combination_config)
                 self.config[opt_key] = opt_dict
+        if self.selection is None:
+            self.selection = Selection(self.combination_config)
         return 0
 
     def getData(self, data):
-        if self.data is None:
-            self._getData(data)
+        if self.data is None and not self.loadCache(data):
+            with stage(f'{type(self).__name__}.getData'):
+                self._getData(data)
+            self.saveCache(data)
 
         return 0
     
+    def _cacheConfig(self):
+        return (type(self).__name__, self.config, self.combination_config)
+
+    def columns(self):
+        columns = []
+        for option in self.config.values():
+            for rs in ['reco', 'sim']:
+                for key in sorted(self.selection.columns()):
+                    columns.append((option[rs], key))
+        return columns
+
     def _getData(self, data):
 
         data_dict = {}
-        options = ['LC', 'Tracksters']
         rs_list = ['reco', 'sim']
+
+        # all the required arrays are read at once. Each of them is flattened
+        # once and all the expressions are evaluated in one pass per branch
+        arrays = data.openArrays(self.columns())
         
         for option_key, option in self.config.items():
             for rs in rs_list:
-                for comb_key in self.combination_config.keys():
-                    if comb_key.split(' ')[-1] == '2.02':
-                        pass
-                    else:
-                        data_dict[f'{option_key}_{rs}_{comb_key}'] = \
-                            Combination._transformData(data, option[rs],\
-                                                       option[comb_key])
+                with stage('Combination.flatten'):
+                    flat_arrays = {key: Combination._transformData(arrays[(option[rs], key)])\
+                                   for key in self.selection.columns()}
+                with stage('Selection.evaluate'):
+                    results = self.selection.evaluate(flat_arrays)
+                for comb_key, result in results.items():
+                    data_dict[f'{option_key}_{rs}_{comb_key}'] = result
         
         self.data = data_dict
         return 0
     
     @staticmethod
-    def _transformData(data, branch, key):
-        import operator
-        operators = {
-            '>=': operator.ge,
-            '<': operator.lt
-        }
+    def _transformData(raw_data):
+        flattened_data = ak.to_numpy(ak.flatten(raw_data))
+
+        return flattened_data
+
 
-        key_list = key.split(' ')
-        if len(key_list) > 1:
-            filter_data = ak.flatten(data.openArray(branch, key_list[0]))
-            op = operators[key_list[1]]
-            #mask needed
-            mask = op(np.array(filter_data), float(key_list[2]))
-            return mask
+class Association(DataProcessor):
+    # association is a key of ticlDumper/associations, e.g.
+    # 'tsCLUE3D_simToReco_CP' (source objects are sim, targets are reco) or
+    # 'tsCLUE3D_recoToSim_CP' (source objects are reco, targets are sim).
+    # Matches of each source object are sorted by score, so the first one is
+    # the best.
+    #
+    # self.data is a dictionary of flat arrays (one element per source object):
+    #       'event'       - event index
+    #       'matched'     - True if there is at least one match
+    #       'local_index' - index of the best target inside its event (-1 if none)
+    #       'score'       - score of the best match (nan if none)
+    def __init__(self, association='tsCLUE3D_simToReco_CP',\
+                 reco='ticlDumper/trackstersCLUE3DHigh;1',\
+                 sim='ticlDumper/simtrackstersCP;1',\
+                 association_branch='ticlDumper/associations;1'):
+        self.data = None
+        self.config = {
+            'association': association,
+            'association_branch': association_branch,
+            'reco': reco,
+            'sim': sim
+        }
+        if 'recoToSim' in association:
+            self.config['source'], self.config['target'] = 'reco', 'sim'
         else:
-            raw_data = data.openArray(branch, key)
-            flattened_data = ak.flatten(raw_data)
+            self.config['source'], self.config['target'] = 'sim', 'reco'
+
+    def getData(self, data):
+        if self.data is None and not self.loadCache(data):
+            with stage(f'{type(self).__name__}.getData'):
+                self._getData(data)
+            self.saveCache(data)
+
+        return 0
+
+    # Returns quantity key of side ('reco' or 'sim') for each source object.
+    # Source quantities are just flattened, target quantities are taken at the
+    # best match (nan, or None for jagged quantities, if there is no match).
+    def gather(self, data, key, side='reco'):
+        self.getData(data)
+        raw_data = data.openArray(self.config[side], key)
+        flat_data = ak.flatten(raw_data, axis=1)
+        if side == self.config['source']:
+            return Association._toNumpy(flat_data)
+
+        index = self._globalIndex(raw_data)
+        matched = self.data['matched']
+        gathered = flat_data[np.where(matched, index, 0)]
+        if gathered.ndim == 1:
+            gathered = ak.to_numpy(gathered).astype(np.float64)
+            gathered[~matched] = np.nan
+            return gathered
+        return ak.mask(gathered, matched)
+
+    def columns(self):
+        branch = self.config['association_branch']
+        return [(branch, self.config['association']),\
+                (branch, f"{self.config['association']}_score")]
+
+    def _getData(self, data):
+        columns = self.columns()
+        arrays = data.openArrays(columns)
+        association = arrays[columns[0]]
+        score = arrays[columns[1]]
+
+        # number of source objects in each event and number of matches of each
+        # source object. Only offsets are used, values of matches are accessed
+        # at the first element of each list.
+        n_sources = ak.to_numpy(ak.num(association, axis=1))
+        n_matches = ak.to_numpy(ak.flatten(ak.num(association, axis=2)))
+        first_match = np.cumsum(n_matches) - n_matches
+        matched = n_matches > 0
+
+        match_values = ak.to_numpy(ak.flatten(association, axis=None))
+        score_values = ak.to_numpy(ak.flatten(score, axis=None))
+
+        local_index = np.full(len(n_matches), -1, dtype=np.int64)
+        local_index[matched] = match_values[first_match[matched]]
+        best_score = np.full(len(n_matches), np.nan)
+        best_score[matched] = score_values[first_match[matched]]
+
+        self.data = {
+            'event': np.repeat(np.arange(len(n_sources)), n_sources),
+            'matched': matched,
+            'local_index': local_index,
+            'score': best_score
+        }
+        return 0
+
+    # Index of the best target in the flattened target array
+    def _globalIndex(self, raw_data):
+        n_targets = ak.to_numpy(ak.num(raw_data, axis=1))
+        offsets = np.concatenate([[0], np.cumsum(n_targets)[:-1]])
+
+        return offsets[self.data['event']] + self.data['local_index']
+
+    @staticmethod
+    def _toNumpy(flat_data):
+        if flat_data.ndim == 1:
+            return ak.to_numpy(flat_data)
+        return flat_data
+
+
+class Efficiency(DataProcessor):
+    # A sim object passes threshold if the score of its best reco match is
+    # lower than threshold (sim objects without matches never pass).
+    #
+    # Efficiency is computed against each variable of binning_config in each
+    # region of region_config (expressions of keys of sim branch, see
+    # Selection.py). bins is either int (number of bins between min and max of
+    # variable, 'log' or 'lin' spaced according to binning_opt) or bin edges for
+    # each variable. Use bin edges if histograms of several files are merged.
+    #
+    # self.data is a dictionary of Histogram objects:
+    #       {name}_{var}_{region}_den             - all sim objects
+    #       {name}_{var}_{region}_num_{threshold} - passing sim objects
+    def __init__(self, thresholds=[0.05, 0.1, 0.2], bins={'E': 10, 'eta': 8},\
+                 binning_opt={'E': 'log', 'eta': 'lin'}, name='LC',\
+                 association='tsCLUE3D_simToReco_CP',\
+                 reco='ticlDumper/trackstersCLUE3DHigh;1',\
+                 sim='ticlDumper/simtrackstersCP;1'):
+        self.data = None
+        self.thresholds = np.sort(np.asarray(thresholds, dtype=np.float64))
+        self.bins = bins
+        self.binning_opt = binning_opt
+        self.name = name
+        self.association = Association(association, reco, sim)
+        self.config = {'sim': sim}
+        self.binning_config = {
+            'E': 'raw_energy',
+            'eta': 'abs(barycenter_eta)'
+        }
+        self.region_config = {
+            'HD': 'abs(barycenter_eta) < 2.02',
+            'LD': 'abs(barycenter_eta) > 2.02',
+            'HD-LD': '(abs(barycenter_eta) > 1.9) & (abs(barycenter_eta) < 2.1)'
+        }
+        self.selection = Selection({**self.binning_config, **self.region_config})
+
+    def getData(self, data):
+        if self.data is None:
+            with stage(f'{type(self).__name__}.getData'):
+                self._getData(data)
+
+        return 0
+
+    def saveHistos(self, output='efficiency_ntuple.json'):
+        return self._saveHistograms(self.data, output)
+
+    # Returns efficiency and its lower and upper limits in each bin. method is
+    # 'wilson' or 'clopper-pearson', cl is a confidence level
+    def getEfficiency(self, var, region='all', threshold=0.1, method='wilson', cl=0.683):
+        numerator = self.data[f'{self.name}_{var}_{region}_num_{threshold}'].counts
+        denominator = self.data[f'{self.name}_{var}_{region}_den'].counts
+        return Efficiency.interval(numerator, denominator, method, cl)
+
+    @staticmethod
+    def interval(numerator, denominator, method='wilson', cl=0.683):
+        from scipy.stats import beta, norm
+
+        k = np.asarray(numerator, dtype=np.float64)
+        n = np.asarray(denominator, dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            efficiency = k/n
+            if method == 'wilson':
+                z = norm.ppf(0.5 + cl/2)
+                center = (k + z**2/2)/(n + z**2)
+                half_width = z*np.sqrt(k*(n - k)/n + z**2/4)/(n + z**2)
+                low, high = center - half_width, center + half_width
+            elif method == 'clopper-pearson':
+                alpha = 1 - cl
+                low = np.where(k > 0, beta.ppf(alpha/2, k, n - k + 1), 0.)
+                high = np.where(k < n, beta.ppf(1 - alpha/2, k + 1, n - k), 1.)
+            else:
+                raise ValueError(f'method = {method} is unavailable. Available'\
+                                 + " methods: ['wilson', 'clopper-pearson']")
+
+        empty = n == 0
+        low = np.where(empty, np.nan, low)
+        high = np.where(empty, np.nan, high)
+        return efficiency, low, high
+
+    def columns(self):
+        return self.association.columns() +\
+               [(self.config['sim'], key) for key in sorted(self.selection.columns())]
+
+    def _getData(self, data):
+        self.association._getData(data)
+        score = self.association.data['score']
+
+        columns = [(self.config['sim'], key) for key in sorted(self.selection.columns())]
+        arrays = data.openArrays(columns)
+        flat_arrays = {key: Combination._transformData(arrays[(branch, key)])\
+                       for branch, key in columns}
+        results = self.selection.evaluate(flat_arrays)
+
+        n_failed, failed_edges = self._failedThresholds(self.thresholds, score)
+
+        regions = {'all': None}
+        regions.update({region: results[region] for region in self.region_config})
+
+        data_dict = {}
+        for var in self.binning_config:
+            edges = self._binEdges(self.bins[var], results[var], self.binning_opt.get(var))
+            for region, mask in regions.items():
+                values = results[var] if mask is None else results[var][mask]
+                failed = n_failed if mask is None else n_failed[mask]
+
+                # all thresholds are filled at once
+                counts = Histogram([failed_edges, edges]).fill(failed, values).counts
+                passed = self._passedThresholds(counts)
 
-        return flattened_data
\ No newline at end of file
+                key = f'{self.name}_{var}_{region}'
+                data_dict[f'{key}_den'] = Histogram([edges], np.sum(counts, axis=0))
+                for i, threshold in enumerate(self.thresholds):
+                    data_dict[f'{key}_num_{threshold}'] = Histogram([edges], passed[i])
+
+        self.data = data_dict
+        return 0
+
+
+class Response(DataProcessor):
+    # Response is E_reco/E_gen of the best reco match (score < threshold) of
+    # each sim object with seed_energy[0] < E_gen < seed_energy[1].
+    #
+    # self.data is a dictionary of 2D Histogram objects
+    # {name}_{region}_th_{threshold} with E_gen on the first axis (e_bins,
+    # 'log' or 'lin' spaced according to binning_opt, or bin edges) and response
+    # on the second one (response_bins).
+    #
+    # fit() fits each E_gen bin of each histogram with Cruijff function in a pool
+    # of processes. Results of a previous fit (e.g. of the reference release,
+    # see loadFits()) are used as initial parameters. getTables() returns scale
+    # (mu) and resolution (sigma/mu) in each E_gen bin.
+    fit_parameters = ['A', 'm', 'sigmaL', 'sigmaR', 'alphaL', 'alphaR']
+
+    def __init__(self, thresholds=[0.1, 0.2], seed_energy=[0., np.inf], e_bins=10,\
+                 binning_opt='log', response_bins=np.linspace(0., 2., 81), name='LC',\
+                 energy='regressed_energy', association='tsCLUE3D_simToReco_CP',\
+                 reco='ticlDumper/trackstersCLUE3DHigh;1',\
+                 sim='ticlDumper/simtrackstersCP;1'):
+        self.data = None
+        self.fits = None
+        self.thresholds = np.sort(np.asarray(thresholds, dtype=np.float64))
+        self.seed_energy = seed_energy
+        self.e_bins = e_bins
+        self.binning_opt = binning_opt
+        self.response_bins = np.asarray(response_bins, dtype=np.float64)
+        self.name = name
+        self.association = Association(association, reco, sim)
+        self.config = {
+            'sim': sim,
+            'energy': energy
+        }
+        self.region_config = {
+            'HD': 'abs(barycenter_eta) < 2.02',
+            'LD': 'abs(barycenter_eta) >= 2.02'
+        }
+        self.selection = Selection({'E': 'raw_energy', **self.region_config})
+
+    def getData(self, data):
+        if self.data is None:
+            with stage(f'{type(self).__name__}.getData'):
+                self._getData(data)
+
+        return 0
+
+    def saveHistos(self, output='response_ntuple.json'):
+        return self._saveHistograms(self.data, output)
+
+    # previous is a dictionary returned by loadFits() (or self.fits of another
+    # Response). workers is a number of processes (default: number of cores)
+    def fit(self, previous=None, workers=None):
+        tasks = []
+        for histo_key, histo in self.data.items():
+            previous_params = None
+            if previous is not None and histo_key in previous:
+                previous_params = previous[histo_key]['params']
+            for e_bin, counts in enumerate(histo.counts):
+                p0 = None
+                if previous_params is not None and e_bin < len(previous_params):
+                    p0 = previous_params[e_bin]
+                tasks.append((histo_key, e_bin, counts, histo.edges[1], p0))
+
+        with stage('Response.fit'), ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(runProfiled, [Response._fitBin]*len(tasks), *zip(*tasks)))\
+                      if len(tasks) > 0 else []
+        params = [bin_params for bin_params, _ in results]
+        for _, trace in results:
+            mergeTrace(trace)
+
+        self.fits = {}
+        for (histo_key, e_bin, _, _, _), bin_params in zip(tasks, params):
+            if histo_key not in self.fits:
+                self.fits[histo_key] = {
+                    'E_bin_edges': self.data[histo_key].edges[0].tolist(),
+                    'params': []
+                }
+            self.fits[histo_key]['params'].append(bin_params)
+
+        return self.fits
+
+    def getTables(self):
+        tables = {'scale': {}, 'resolution': {}, 'E_bin_edges': {}}
+        for histo_key, fit in self.fits.items():
+            params = np.array(fit['params'], dtype=np.float64)
+            mu = params[:, 1]
+            sigma = (params[:, 2] + params[:, 3])/2
+            tables['scale'][histo_key] = mu
+            tables['resolution'][histo_key] = sigma/mu
+            tables['E_bin_edges'][histo_key] = np.array(fit['E_bin_edges'])
+        return tables
+
+    def saveFits(self, output='response_fits.json'):
+        with open(output, 'w') as file:
+            json.dump(self.fits, file, indent=4)
+
+    @staticmethod
+    def loadFits(input='response_fits.json'):
+        with open(input, 'r') as file:
+            return json.load(file)
+
+    @staticmethod
+    def cruijff(x, A, m, sigmaL, sigmaR, alphaL, alphaR):
+        dx = x - m
+        left = dx < 0
+        sigma = np.where(left, sigmaL, sigmaR)
+        alpha = np.where(left, alphaL, alphaR)
+        f = 2*sigma*sigma + alpha*dx*dx
+        return A*np.exp(-dx*dx/f)
+
+    # Initial parameters from histogram: maximum, mean, quantile differences
+    # for sigmas and tails ratio for alphas
+    @staticmethod
+    def _initialParams(counts, bin_centers):
+        mean = np.average(bin_centers, weights=counts)
+        cdf = (np.cumsum(counts) - 0.5*counts)/np.sum(counts)
+        q_min2, q_min1, median, q_plus1, q_plus2 = np.interp(\
+            [0.5 - 0.95/2, 0.5 - 0.68/2, 0.5, 0.5 + 0.68/2, 0.5 + 0.95/2], cdf, bin_centers)
+
+        return [
+            np.max(counts),
+            mean,
+            median - q_min1,
+            q_plus1 - median,
+            (q_min1 - q_min2)/(median - q_min1)/3.81*0.28067382,
+            (q_plus2 - q_plus1)/(q_plus1 - median)/3.81*0.28067382
+        ]
+
+    # Fits one E_gen bin. Returns list of Cruijff parameters (nan if the bin
+    # can not be fitted)
+    @staticmethod
+    def _fitBin(histo_key, e_bin, counts, edges, p0=None):
+        from scipy.optimize import curve_fit
+
+        failed = [np.nan]*len(Response.fit_parameters)
+        counts = np.asarray(counts, dtype=np.float64)
+        if np.count_nonzero(counts) < len(Response.fit_parameters):
+            return failed
+
+        bin_centers = (edges[1:] + edges[:-1])/2
+        if p0 is None or not np.all(np.isfinite(p0)):
+            p0 = Response._initialParams(counts, bin_centers)
+        sigma = np.maximum(np.sqrt(counts), 1.8)
+        bounds = ([0., -np.inf, 0., 0., -np.inf, -np.inf], np.inf)
+
+        try:
+            params, _ = curve_fit(Response.cruijff, bin_centers, counts, p0=p0, sigma=sigma,\
+                                  absolute_sigma=True, maxfev=50000, bounds=bounds)
+        except ValueError:
+            # sometimes it fails with infs or NaNs and removing bounds helps
+            try:
+                params, _ = curve_fit(Response.cruijff, bin_centers, counts, p0=p0,\
+                                      sigma=sigma, absolute_sigma=True, maxfev=50000)
+            except (ValueError, RuntimeError):
+                return failed
+        except RuntimeError:
+            return failed
+
+        return params.tolist()
+
+    def columns(self):
+        return self.association.columns() +\
+               [(self.association.config['reco'], self.config['energy'])] +\
+               [(self.config['sim'], key) for key in sorted(self.selection.columns())]
+
+    def _getData(self, data):
+        self.association._getData(data)
+        score = self.association.data['score']
+        e_reco = self.association.gather(data, self.config['energy'], 'reco')
+
+        columns = [(self.config['sim'], key) for key in sorted(self.selection.columns())]
+        arrays = data.openArrays(columns)
+        flat_arrays = {key: Combination._transformData(arrays[(branch, key)])\
+                       for branch, key in columns}
+        results = self.selection.evaluate(flat_arrays)
+
+        e_gen = results['E']
+        in_range = (e_gen > self.seed_energy[0]) & (e_gen < self.seed_energy[1])\
+                   & self.association.data['matched']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            response = e_reco/e_gen
+
+        n_failed, failed_edges = self._failedThresholds(self.thresholds, score)
+        e_edges = self._binEdges(self.e_bins, e_gen[in_range], self.binning_opt)
+
+        data_dict = {}
+        for region in self.region_config:
+            mask = in_range & results[region]
+            # all thresholds and E_gen bins are filled at once
+            counts = Histogram([failed_edges, e_edges, self.response_bins])\
+                     .fill(n_failed[mask], e_gen[mask], response[mask]).counts
+            passed = self._passedThresholds(counts)
+            for i, threshold in enumerate(self.thresholds):
+                data_dict[f'{self.name}_{region}_th_{threshold}'] =\
+                    Histogram([e_edges, self.response_bins], passed[i])
+
+        self.data = data_dict
+        return 0
+
+
+class EventDisplacement(DataProcessor):
+    # Each reco trackster is compared to the sim trackster of the same event
+    # closest in (eta, phi). Vertices of reco trackster are grouped by layer
+    # (zToLayerID()) and the centroid (x, y, z) of each group is compared to
+    # the point of the sim axis (barycenter + t*eVector0) with the same z.
+    #
+    # self.data is a dictionary of flat arrays with one element per (trackster,
+    # layer) pair:
+    #       {name}_dx, {name}_dy - displacement of centroid from sim axis
+    #       {name}_dr            - its transverse length
+    #       {name}_layer         - layer id
+    #
+    # bins is a dictionary {'dx': bins, 'dy': bins, 'dr': bins}, bins are either
+    # number of bins or bin edges (use bin edges if histograms of several files
+    # are merged).
+    #
+    # The closest sim trackster is found among all the (reco, sim) pairs of an
+    # event, so memory grows as n_reco*n_sim per event (~1e5 pairs per event at
+    # PU200). Use getData(data, step_size) (or iterData()) to process full
+    # samples in chunks of step_size events (e.g. 100 events at PU200).
+    def __init__(self, bins={'dx': 50, 'dy': 50, 'dr': 50}, name='Candidates',\
+                 reco='ticlDumper/trackstersTiclCandidate;1',\
+                 sim='ticlDumper/simtrackstersCP;1'):
+        super().__init__()
+        self.data = None
+        self.bins = bins
+        self.name = name
+        self.config = {
+            'reco': reco,
+            'sim': sim
+        }
+        self.reco_keys = ['vertices_x', 'vertices_y', 'vertices_z', 'barycenter_eta', 'barycenter_phi']
+        self.sim_keys = ['barycenter_x', 'barycenter_y', 'barycenter_z', 'eVector0_x', 'eVector0_y',\
+                         'eVector0_z', 'barycenter_eta', 'barycenter_phi']
+
+    # data is a DataFile object (or DataChunk if step_size is None). If
+    # step_size is given, data is processed chunk by chunk (see iterData()) and
+    # flat arrays of chunks are concatenated
+    def getData(self, data, step_size=None):
+        if self.data is None and not self.loadCache(data):
+            with stage(f'{type(self).__name__}.getData'):
+                if step_size is None:
+                    self._getData(data)
+                else:
+                    chunks = list(self.iterData(data, step_size))
+                    self.data = {key: np.concatenate([chunk[key] for chunk in chunks])\
+                                 for key in chunks[0]}
+            self.saveCache(data)
+
+        return 0
+
+    # data is a DataFile object. step_size is passed to DataFile.iterate(). The
+    # map is computed from the whole file before the first chunk
+    def iterData(self, data, step_size=100000):
+        if self.zToID is None:
+            self.zToIDMap(data)
+        for chunk in data.iterate(self.columns(), step_size):
+            yield self.chunkData(chunk)
+
+    def saveHistos(self, output='displacement_ntuple.json'):
+        layer = self.data[f'{self.name}_layer']
+        layer_edges = np.arange(0.5, np.max(layer, initial=0) + 1.5)
+
+        histograms = {}
+        for var in ['dx', 'dy', 'dr']:
+            values = self.data[f'{self.name}_{var}']
+            edges = self._binEdges(self.bins[var], values)
+            histograms[f'{self.name}_{var}'] = Histogram([edges]).fill(values)
+            histograms[f'{self.name}_{var}_layer'] = Histogram([layer_edges, edges]).fill(layer, values)
+        return self._saveHistograms(histograms, output)
+
+    def _cacheConfig(self):
+        return (type(self).__name__, self.config, self.name)
+
+    def columns(self):
+        return [(self.config['reco'], key) for key in self.reco_keys] +\
+               [(self.config['sim'], key) for key in self.sim_keys]
+
+    def _getData(self, data):
+        if self.zToID is None:
+            self.zToIDMap(data)
+
+        # vertices_* are the largest arrays of the file, they are read once and
+        # not cached
+        arrays = data.openArrays(self.columns(), cache=False)
+        reco = {key: arrays[(self.config['reco'], key)] for key in self.reco_keys}
+        sim = {key: arrays[(self.config['sim'], key)] for key in self.sim_keys}
+
+        sim_index, matched = self._closestSim(reco, sim)
+
+        # vertices of all the tracksters of all the events in flat arrays
+        n_vertices = ak.to_numpy(ak.flatten(ak.num(reco['vertices_x'], axis=2)))
+        trackster = np.repeat(np.arange(len(n_vertices)), n_vertices)
+        x, y, z = [ak.to_numpy(ak.flatten(reco[f'vertices_{axis}'], axis=None)).astype(np.float64)\
+                   for axis in 'xyz']
+        layer = self.zToLayerID(z)
+
+        # centroid of each (trackster, layer) group
+        n_layers = len(self.zToID) + 2
+        groups, group_index = np.unique(trackster*n_layers + layer, return_inverse=True)
+        n_group_vertices = np.bincount(group_index)
+        centroid = [np.bincount(group_index, weights=values)/n_group_vertices\
+                    for values in [x, y, z]]
+        group_trackster = groups // n_layers
+        group_layer = groups % n_layers
+
+        # groups of tracksters without sim trackster in the event are dropped
+        # before sim arrays are indexed
+        group_matched = matched[group_trackster]
+        centroid = [values[group_matched] for values in centroid]
+        group_sim = sim_index[group_trackster[group_matched]]
+        group_layer = group_layer[group_matched]
+
+        # point of sim axis at z of centroid
+        sim_flat = {key: ak.to_numpy(ak.flatten(sim[key])).astype(np.float64)\
+                    for key in self.sim_keys}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = (centroid[2] - sim_flat['barycenter_z'][group_sim])/sim_flat['eVector0_z'][group_sim]
+            dx = centroid[0] - (sim_flat['barycenter_x'][group_sim] + t*sim_flat['eVector0_x'][group_sim])
+            dy = centroid[1] - (sim_flat['barycenter_y'][group_sim] + t*sim_flat['eVector0_y'][group_sim])
+        valid = np.isfinite(dx) & np.isfinite(dy)
+
+        self.data = {
+            f'{self.name}_dx': dx[valid],
+            f'{self.name}_dy': dy[valid],
+            f'{self.name}_dr': np.hypot(dx[valid], dy[valid]),
+            f'{self.name}_layer': group_layer[valid]
+        }
+        return 0
+
+    # Returns index of the closest sim trackster in the flattened sim arrays
+    # for each reco trackster (0 if there is no sim trackster in the event) and
+    # mask of reco tracksters with a sim trackster in the event
+    def _closestSim(self, reco, sim):
+        reco_direction = ak.zip({'eta': reco['barycenter_eta'], 'phi': reco['barycenter_phi']})
+        sim_direction = ak.zip({'eta': sim['barycenter_eta'], 'phi': sim['barycenter_phi']})
+        reco_pairs, sim_pairs = ak.unzip(ak.cartesian([reco_direction, sim_direction], nested=True))
+
+        delta_phi = (reco_pairs.phi - sim_pairs.phi + np.pi) % (2*np.pi) - np.pi
+        delta_r2 = (reco_pairs.eta - sim_pairs.eta)**2 + delta_phi**2
+        local_index = ak.flatten(ak.argmin(delta_r2, axis=2))
+        matched = ak.to_numpy(~ak.is_none(local_index))
+        local_index = ak.to_numpy(ak.fill_none(local_index, 0))
+
+        n_sim = ak.to_numpy(ak.num(sim['barycenter_x'], axis=1))
+        n_reco = ak.to_numpy(ak.num(reco['barycenter_eta'], axis=1))
+        offsets = np.repeat(np.cumsum(n_sim) - n_sim, n_reco)
+        return np.where(matched, offsets + local_index, 0), matched
+
+
+class PCAResolution(DataProcessor):
+    # Resolution is |theta_sim - theta_reco|, where theta is the polar angle of
+    # the PCA axis (eVector0) of reco trackster and of the axis of its sim
+    # trackster: PCA (pca_match='pca') or boundary direction
+    # (pca_match='boundary'). The sim trackster is the best match of reco
+    # trackster in association (reco-to-sim). If gen_match=True, only reco
+    # tracksters with score < gen_threshold are used.
+    #
+    # binning_keys are any of reco_variables and sim_variables. bins and
+    # binning_opt ('lin' or 'log') are given for each binning key, bins are
+    # either number of bins or bin edges. data_bins are bins of resolution.
+    #
+    # self.data is a dictionary with one (N+1)-dimensional Histogram
+    # {name}_dtheta, axes are binning_keys and resolution (the last one). It is
+    # filled in one pass over all the tracksters. saveHistos() writes the
+    # combined resolution and its 2D projection on each binning axis.
+    #
+    # Use runSamples() to process several files (e.g. PU0 and PU200 samples)
+    # in parallel.
+    reco_variables = {
+        'eta': 'abs(barycenter_eta)',
+        'phi': 'barycenter_phi',
+        'e_raw': 'raw_energy',
+        'e_reg': 'regressed_energy',
+        'pT': 'raw_pt',
+        'ev': 'EV1/(EV1 + EV2 + EV3)'
+    }
+
+    sim_variables = {
+        'e_seed': 'raw_energy',
+        'cp_energy': 'regressed_energy'
+    }
+
+    def __init__(self, binning_keys=['eta', 'e_seed'], bins=[5, 4], binning_opt=['lin', 'log'],\
+                 pca_match='pca', gen_match=False, gen_threshold=0.2, data_bins=20, name='LC',\
+                 association='tsCLUE3D_recoToSim_CP',\
+                 reco='ticlDumper/trackstersCLUE3DHigh;1',\
+                 sim='ticlDumper/simtrackstersCP;1'):
+        if len(binning_keys) != len(bins):
+            raise ValueError('number of binning keys must be equal to length of bins'\
+                             + f' (current: {len(binning_keys)}, {len(bins)})')
+        if len(binning_keys) != len(binning_opt):
+            raise ValueError('number of binning keys must be equal to number of binning options')
+        for key in binning_keys:
+            if key not in PCAResolution.reco_variables and key not in PCAResolution.sim_variables:
+                raise KeyError(f'binning key = {key} is unavailable. Available keys:'\
+                               + f' {list(PCAResolution.reco_variables)}'\
+                               + f' {list(PCAResolution.sim_variables)}')
+        if pca_match not in ['pca', 'boundary']:
+            raise ValueError(f"pca_match = {pca_match} is unavailable. Use 'pca' or 'boundary'")
+
+        self.data = None
+        self.binning_keys = binning_keys
+        self.bins = bins
+        self.binning_opt = binning_opt
+        self.data_bins = data_bins
+        self.gen_match = gen_match
+        self.gen_threshold = gen_threshold
+        self.name = name
+        self.association = Association(association, reco, sim)
+        self.config = {
+            'reco': reco,
+            'sim': sim,
+            'reco_axis': ['eVector0_x', 'eVector0_y', 'eVector0_z'],
+            'sim_axis': {'pca': ['eVector0_x', 'eVector0_y', 'eVector0_z'],\
+                         'boundary': ['boundaryX', 'boundaryY', 'boundaryZ']}[pca_match]
+        }
+        self.reco_selection = Selection({key: PCAResolution.reco_variables[key]\
+                                         for key in binning_keys if key in PCAResolution.reco_variables})
+        self.sim_selection = Selection({key: PCAResolution.sim_variables[key]\
+                                        for key in binning_keys if key in PCAResolution.sim_variables})
+
+    def getData(self, data):
+        if self.data is None:
+            with stage(f'{type(self).__name__}.getData'):
+                self._getData(data)
+
+        return 0
+
+    def saveHistos(self, output='pca_ntuple.json'):
+        histo = self.data[f'{self.name}_dtheta']
+        resolution_axis = histo.ndim - 1
+
+        histograms = {f'{self.name}_dtheta': histo.project(resolution_axis)}
+        for axis, key in enumerate(self.binning_keys):
+            histograms[f'{self.name}_dtheta_{key}'] = histo.project(axis, resolution_axis)
+        return self._saveHistograms(histograms, output)
+
+    # samples is a dictionary {sample name: path of file}. Each file is
+    # processed in a separate process. Returns a dictionary {sample name:
+    # PCAResolution} with filled self.data
+    @staticmethod
+    def runSamples(samples, workers=None, **kwargs):
+        names = list(samples.keys())
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(runProfiled, [PCAResolution._runSample]*len(names),\
+                                        [samples[name] for name in names],\
+                                        [kwargs]*len(names)))
+        for _, trace in results:
+            mergeTrace(trace)
+        return dict(zip(names, [processor for processor, _ in results]))
+
+    @staticmethod
+    def _runSample(filepath, kwargs):
+        from .DataFile import DataFile
+
+        processor = PCAResolution(**kwargs)
+        processor.getData(DataFile(filepath, cache_size=0))
+        return processor
+
+    def columns(self):
+        return self.association.columns() +\
+               [(self.config['reco'], key) for key in\
+                self.config['reco_axis'] + sorted(self.reco_selection.columns())] +\
+               [(self.config['sim'], key) for key in\
+                self.config['sim_axis'] + sorted(self.sim_selection.columns())]
+
+    def _getData(self, data):
+        self.association._getData(data)
+        matched = self.association.data['matched']
+        if self.gen_match:
+            matched = matched & (self.association.data['score'] < self.gen_threshold)
+
+        reco_keys = self.config['reco_axis'] + sorted(self.reco_selection.columns())
+        arrays = data.openArrays([(self.config['reco'], key) for key in reco_keys])
+        reco = {key: Combination._transformData(arrays[(self.config['reco'], key)]).astype(np.float64)\
+                for key in reco_keys}
+        # sim quantities of the best match of each reco trackster (nan if none)
+        sim_keys = self.config['sim_axis'] + sorted(self.sim_selection.columns())
+        sim = {key: self.association.gather(data, key, 'sim') for key in sim_keys}
+
+        theta_reco = PCAResolution._theta(*[reco[key] for key in self.config['reco_axis']])
+        theta_sim = PCAResolution._theta(*[sim[key] for key in self.config['sim_axis']])
+        variables = {**self.reco_selection.evaluate(reco), **self.sim_selection.evaluate(sim)}
+
+        with np.errstate(invalid='ignore'):
+            resolution = np.abs(theta_sim - theta_reco)
+        valid = matched & np.isfinite(resolution)
+        for key in self.binning_keys:
+            valid &= np.isfinite(variables[key])
+
+        values = [variables[key][valid] for key in self.binning_keys] + [resolution[valid]]
+        edges = [self._binEdges(bins, axis_values, opt) for bins, opt, axis_values in\
+                 zip(self.bins + [self.data_bins], self.binning_opt + ['lin'], values)]
+
+        self.data = {f'{self.name}_dtheta': Histogram(edges).fill(*values)}
+        return 0
+
+    @staticmethod
+    def _theta(x, y, z):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.arctan(np.hypot(x, y)/z)
@@ -0,0 +1,111 @@
+# This file contains an opt-in persistent cache of derived arrays (e.g.
+# flattened arrays of processors), so that repeated runs over the same file
+# skip reading and decoding of ROOT baskets:
+#       data = DataFile(filepath, disk_cache=DiskCache())
+#       processor.getData(data)     # computed once, then loaded from the cache
+#
+# Each entry is a directory {key}/ in DiskCache.directory with one .npy file per
+# array and index.json with names of the arrays. Arrays are loaded
+# memory-mapped. The key is a hash of the absolute path, modification time and
+# size of the source file and of the configuration of the processor, so
+# entries of modified files or processors are never used.
+#
+# The total size of the cache is bounded by size_limit (in bytes). The least
+# recently used entries are removed when it is exceeded. Entries are written
+# into a temporary directory and renamed, so parallel jobs never see half of
+# an entry.
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+from typing import Dict
+
+class DiskCache:
+    def __init__(self, directory=None, size_limit=10*2**30):
+        if directory is None:
+            directory = os.path.join(os.environ.get('TICL_VALIDATION_CACHE',\
+                                     os.path.join(os.path.expanduser('~'), '.cache',\
+                                                  'ticl_validation')), 'arrays')
+        self.directory = directory
+        self.size_limit = size_limit
+
+    # config is any object with stable repr() (e.g. dictionary of strings)
+    @staticmethod
+    def key(filepath, config):
+        stat = os.stat(filepath)
+        source = f'{os.path.abspath(filepath)}|{stat.st_mtime_ns}|{stat.st_size}|{config!r}'
+        return hashlib.sha256(source.encode()).hexdigest()
+
+    # Returns a dictionary {name: memory-mapped array} or None if there is no entry
+    def load(self, key):
+        entry = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(entry, 'index.json'), 'r') as file:
+                index = json.load(file)
+            arrays = {name: np.load(os.path.join(entry, filename), mmap_mode='r')\
+                      for name, filename in index.items()}
+        except (FileNotFoundError, ValueError):
+            return None
+
+        # modification time of entry is its last use
+        os.utime(entry)
+        return arrays
+
+    # arrays is a dictionary {name: numpy array}
+    def save(self, key, arrays: Dict[str, np.ndarray]):
+        os.makedirs(self.directory, exist_ok=True)
+        entry = os.path.join(self.directory, key)
+        tmp_entry = f'{entry}.{os.getpid()}.tmp'
+        os.makedirs(tmp_entry, exist_ok=True)
+
+        index = {}
+        for i, (name, array) in enumerate(arrays.items()):
+            index[name] = f'{i}.npy'
+            np.save(os.path.join(tmp_entry, index[name]), np.asarray(array))
+        with open(os.path.join(tmp_entry, 'index.json'), 'w') as file:
+            json.dump(index, file)
+
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # the entry is already written by another job
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+        self._evict()
+        return 0
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        return 0
+
+    def size(self):
+        return sum(size for _, _, size in self._entries())
+
+    # Removes the least recently used entries until the cache fits into size_limit
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        total_size = sum(size for _, _, size in entries)
+        for entry, _, size in entries:
+            if total_size <= self.size_limit:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total_size -= size
+        return 0
+
+    # Returns a list of (path, last use, size) of complete entries
+    def _entries(self):
+        if not os.path.isdir(self.directory):
+            return []
+
+        entries = []
+        for name in os.listdir(self.directory):
+            entry = os.path.join(self.directory, name)
+            if name.endswith('.tmp') or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(file.stat().st_size for file in os.scandir(entry))
+                entries.append((entry, os.stat(entry).st_mtime, size))
+            except FileNotFoundError:
+                continue
+        return entries
@@ -0,0 +1,231 @@
+# This file contains a histogram accumulator used by NTupler.
+#
+# Histogram has fixed bin edges given at construction, so that histograms
+# filled from different chunks, files or processes can be added together
+# exactly:
+#       h = Histogram([edges])                  # 1D
+#       h = Histogram([c_data_edges, edges])    # 2D, first axis is c_data
+#       h.fill(data) / h.fill(c_data, data)
+#       h.merge(other)  (or h += other)
+#
+# toDict() and fromDict() convert a histogram to (from) the format of NTuples:
+#       {"data": counts, "data_bin_edges": edges, "c_data_bin_edges": c_edges}
+# where "c_data_bin_edges" is present only for 2D histograms. Histograms with
+# more axes are stored as
+#       {"data": counts, "bin_edges_0": edges, "bin_edges_1": edges, ...}
+#
+# SparseHistogram has the same interface for high-dimensional binnings: only
+# non-empty bins are stored (flat bin index and count). Each axis has also
+# underflow and overflow bins, so that an entry out of range of one axis is
+# still counted in projections on the other axes. Use project() to get dense
+# 1D or 2D views. It is stored as
+#       {"sparse_index": index, "sparse_counts": counts, "bin_edges_0": edges,
+#        ..., "axis_names": names}
+import numpy as np
+from typing import List, Dict
+
+class Histogram:
+    def __init__(self, edges: List[List[float]], counts=None):
+        self.edges = [np.asarray(axis_edges, dtype=np.float64) for axis_edges in edges]
+        shape = tuple(len(axis_edges) - 1 for axis_edges in self.edges)
+        if counts is None:
+            self.counts = np.zeros(shape, dtype=np.int64)
+        else:
+            self.counts = np.asarray(counts, dtype=np.int64).reshape(shape)
+
+    @property
+    def ndim(self):
+        return len(self.edges)
+
+    # arrays are given in the order of axes
+    def fill(self, *arrays):
+        if len(arrays) != self.ndim:
+            raise ValueError(f'histogram has {self.ndim} axes, but {len(arrays)}'\
+                             + ' arrays are given')
+
+        arrays = [np.asarray(array, dtype=np.float64) for array in arrays]
+        if self.ndim == 1:
+            counts, _ = np.histogram(arrays[0], bins=self.edges[0])
+        else:
+            counts, _ = np.histogramdd(np.stack(arrays, axis=-1), bins=self.edges)
+        self.counts += counts.astype(np.int64)
+        return self
+
+    def merge(self, other: 'Histogram'):
+        if not self.hasSameEdges(other):
+            raise ValueError('histograms with different bin edges can not be merged')
+        self.counts += other.counts
+        return self
+
+    def __iadd__(self, other: 'Histogram'):
+        return self.merge(other)
+
+    def __add__(self, other: 'Histogram'):
+        return self.copy().merge(other)
+
+    def copy(self):
+        return Histogram(self.edges, self.counts.copy())
+
+    # Histogram of the given axes (in the given order), all the other axes are
+    # summed over
+    def project(self, *axes):
+        summed_axes = tuple(axis for axis in range(self.ndim) if axis not in axes)
+        counts = np.sum(self.counts, axis=summed_axes)
+        counts = np.transpose(counts, [sorted(axes).index(axis) for axis in axes])
+        return Histogram([self.edges[axis] for axis in axes], counts)
+
+    def hasSameEdges(self, other: 'Histogram'):
+        if self.ndim != other.ndim:
+            return False
+        return all(np.array_equal(edges, other_edges)\
+                   for edges, other_edges in zip(self.edges, other.edges))
+
+    def toDict(self):
+        if self.ndim > 2:
+            histogram = {"data": self.counts.tolist()}
+            for axis, edges in enumerate(self.edges):
+                histogram[f"bin_edges_{axis}"] = edges.tolist()
+            return histogram
+
+        histogram = {
+            "data": self.counts.tolist(),
+            "data_bin_edges": self.edges[-1].tolist()
+        }
+        if self.ndim == 2:
+            histogram["c_data_bin_edges"] = self.edges[0].tolist()
+
+        return histogram
+
+    # Returns Histogram or SparseHistogram
+    @staticmethod
+    def fromDict(histogram: Dict[str, List]):
+        if "sparse_index" in histogram:
+            return SparseHistogram.fromDict(histogram)
+        if "bin_edges_0" in histogram:
+            return Histogram(Histogram._axisEdges(histogram), histogram['data'])
+
+        edges = [histogram['data_bin_edges']]
+        if 'c_data_bin_edges' in histogram:
+            edges = [histogram['c_data_bin_edges']] + edges
+
+        return Histogram(edges, histogram['data'])
+
+    @staticmethod
+    def isMultiDim(histogram: Dict[str, List]):
+        return "bin_edges_0" in histogram
+
+    @staticmethod
+    def _axisEdges(histogram: Dict[str, List]):
+        edges = []
+        while f"bin_edges_{len(edges)}" in histogram:
+            edges.append(histogram[f"bin_edges_{len(edges)}"])
+        return edges
+
+class SparseHistogram:
+    # names are optional names of axes (e.g. combination keys)
+    def __init__(self, edges: List[List[float]], index=None, counts=None, names=None):
+        self.edges = [np.asarray(axis_edges, dtype=np.float64) for axis_edges in edges]
+        self.names = names
+        # underflow and overflow bins on each axis
+        self.shape = tuple(len(axis_edges) + 1 for axis_edges in self.edges)
+        if index is None:
+            self.index = np.zeros(0, dtype=np.int64)
+            self.counts = np.zeros(0, dtype=np.int64)
+        else:
+            self.index = np.asarray(index, dtype=np.int64)
+            self.counts = np.asarray(counts, dtype=np.int64)
+
+    @property
+    def ndim(self):
+        return len(self.edges)
+
+    def fill(self, *arrays):
+        if len(arrays) != self.ndim:
+            raise ValueError(f'histogram has {self.ndim} axes, but {len(arrays)}'\
+                             + ' arrays are given')
+
+        bins = [SparseHistogram._axisBins(edges, np.asarray(array, dtype=np.float64))\
+                for edges, array in zip(self.edges, arrays)]
+        index, counts = np.unique(np.ravel_multi_index(bins, self.shape), return_counts=True)
+        self._add(index, counts)
+        return self
+
+    def merge(self, other: 'SparseHistogram'):
+        if not self.hasSameEdges(other):
+            raise ValueError('histograms with different bin edges can not be merged')
+        self._add(other.index, other.counts)
+        return self
+
+    def __iadd__(self, other: 'SparseHistogram'):
+        return self.merge(other)
+
+    def __add__(self, other: 'SparseHistogram'):
+        return self.copy().merge(other)
+
+    def copy(self):
+        return SparseHistogram(self.edges, self.index.copy(), self.counts.copy(), self.names)
+
+    def hasSameEdges(self, other):
+        if not isinstance(other, SparseHistogram) or self.ndim != other.ndim:
+            return False
+        return all(np.array_equal(edges, other_edges)\
+                   for edges, other_edges in zip(self.edges, other.edges))
+
+    # Dense Histogram of the given axes (in the given order). Entries out of
+    # range of these axes are dropped, all the other axes are summed over
+    # (including underflow and overflow). select is a dictionary {axis: bin}
+    # of bins of other axes to take instead of summing over them.
+    def project(self, *axes, select={}):
+        bins = np.unravel_index(self.index, self.shape)
+        mask = np.ones(len(self.index), dtype=bool)
+        for axis, axis_bin in select.items():
+            mask &= bins[axis] == axis_bin + 1
+        for axis in axes:
+            mask &= (bins[axis] >= 1) & (bins[axis] < self.shape[axis] - 1)
+
+        shape = tuple(self.shape[axis] - 2 for axis in axes)
+        flat_index = np.ravel_multi_index([bins[axis][mask] - 1 for axis in axes], shape)
+        counts = np.bincount(flat_index, weights=self.counts[mask], minlength=int(np.prod(shape)))
+        return Histogram([self.edges[axis] for axis in axes], counts.astype(np.int64))
+
+    def toDense(self):
+        return self.project(*range(self.ndim))
+
+    def toDict(self):
+        histogram = {
+            "sparse_index": self.index.tolist(),
+            "sparse_counts": self.counts.tolist()
+        }
+        for axis, edges in enumerate(self.edges):
+            histogram[f"bin_edges_{axis}"] = edges.tolist()
+        if self.names is not None:
+            histogram["axis_names"] = list(self.names)
+
+        return histogram
+
+    @staticmethod
+    def fromDict(histogram: Dict[str, List]):
+        names = histogram.get('axis_names')
+        if names is not None:
+            names = [str(name) for name in names]
+        return SparseHistogram(Histogram._axisEdges(histogram), histogram['sparse_index'],\
+                               histogram['sparse_counts'], names)
+
+    # Bin of each value: 0 is underflow, len(edges) is overflow (and nan). As in
+    # np.histogram the last bin includes its right edge
+    @staticmethod
+    def _axisBins(edges, values):
+        bins = np.searchsorted(edges, values, side='right')
+        bins[values == edges[-1]] = len(edges) - 1
+        return bins
+
+    def _add(self, index, counts):
+        if len(self.index) == 0:
+            self.index, self.counts = np.asarray(index, dtype=np.int64), np.asarray(counts, dtype=np.int64)
+            return 0
+
+        index, inverse = np.unique(np.concatenate([self.index, index]), return_inverse=True)
+        self.counts = np.bincount(inverse, weights=np.concatenate([self.counts, counts]))\
+                      .astype(np.int64)
+        self.index = index
+        return 0
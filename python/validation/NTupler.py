@@ -1,9 +1,13 @@
 # This file is dedicated to specify all the required classes
 # and function for TICL validation NTuples production
-import numpy as np
-import json
 import os
+import hashlib
+import numpy as np
+import fcntl
 from typing import List
+from .Histogram import Histogram, SparseHistogram
+from .Storage import openStorage
+from .Profiler import stage
 
 class NTupler:
     # Later bins would have to be in either int (representing number of bins),
@@ -12,16 +16,98 @@ class NTupler:
     # (representing bin edges for each key in data or combined data)
     #
     # !!! It would be better to extract these data from config file !!!
-    def __init__(self, data, combination_data, data_bins = 10, c_data_bins = 10, output = "output.json"):
+    #
+    # Format of output is defined by its extension (.json or .npz), see
+    # Storage.py. Use exportHistos() to save histograms in another format.
+    #
+    # mode is 'w' (output file is overwritten) or 'a' (histograms are added to
+    # the ones already stored in output file, histograms with the same name
+    # are replaced). In 'a' mode the output file is locked while being
+    # updated, so several processes may append to the same file. Lock files
+    # are kept in $TICL_VALIDATION_CACHE/locks (default ~/.cache/ticl_validation),
+    # not next to the output.
+    #
+    # Each data key is histogrammed once in all the combination keys together:
+    # a SparseHistogram with axes (E, ET, eta, HD, LD, data) is filled in one
+    # pass (masks HD and LD are axes with bins False and True). 2D histograms
+    # {key}_{comb_key} (and 1D for masks) are its projections. If
+    # nd_histos=True, only the N-dimensional histograms {key}_nd are stored
+    # instead of projections; use project() (or Plotter) to get them on demand.
+    # If data_bins is a number of bins, {key}_HD and {key}_LD are filled
+    # separately in the range of masked data, while the data axis of {key}_nd
+    # spans all the data, so their projections from {key}_nd differ. Give bin
+    # edges to get the same histograms in both modes.
+    combination_keys = ['E', 'ET', 'eta', 'HD', 'LD']
+    mask_edges = [-0.5, 0.5, 1.5]
+
+    def __init__(self, data, combination_data, data_bins = 10, c_data_bins = 10, output = "output.json", mode = 'w', nd_histos = False):
         self.data = data
         self.combination_data = combination_data
         self.data_bins = data_bins
         self.c_data_bins = c_data_bins
         self.output = output
-
-    # data and combination_data are dictionaries of arrays
+        self.mode = mode
+        self.nd_histos = nd_histos
+        self.histograms = {}
+        self.streaming = False
+        self._new_histograms = None
+
+    # data and combination_data are dictionaries of arrays. All the histograms
+    # are kept in self.histograms and written to output at once.
     def makeHist(self):
+        self.histograms = {}
+        self._fillHistos()
+        self.saveHistos()
+
+    # Streaming mode: data and combination_data of each chunk (e.g. yielded by
+    # Multiplicity.iterData() and Combination.iterData()) are accumulated in
+    # self.histograms (dictionary of Histogram objects). Bins have to be given
+    # as bin edges, otherwise histograms of different chunks would have
+    # different binning. Histograms of another NTupler (e.g. filled from
+    # another file) are added with merge(). Use saveHistos() at the end.
+    def fillChunk(self, data, combination_data):
+        self.streaming = True
+        self.data = data
+        self.combination_data = combination_data
+        self._fillHistos()
 
+    # Add a Histogram produced outside of NTupler (e.g. by Efficiency processor)
+    def addHisto(self, histo_key, histo):
+        self._mergeHisto(histo_key, histo)
+        return self
+
+    def merge(self, other: 'NTupler'):
+        for histo_key, histo in other.histograms.items():
+            self._mergeHisto(histo_key, histo.copy())
+        return self
+
+    # Returns 2D Histogram {histo_key}_{comb_key} (1D for masks) projected from
+    # N-dimensional histogram {histo_key}_nd
+    def project(self, histo_key, comb_key):
+        return NTupler.projectHisto(self.histograms[f'{histo_key}_nd'], comb_key)
+
+    @staticmethod
+    def projectHisto(histo, comb_key):
+        axis = histo.names.index(comb_key)
+        data_axis = histo.ndim - 1
+        if np.array_equal(histo.edges[axis], NTupler.mask_edges):
+            return histo.project(data_axis, select={axis: 1})
+        return histo.project(axis, data_axis)
+
+    def saveHistos(self):
+        histograms = {histo_key: histo.toDict() for histo_key, histo in self.histograms.items()}
+        self._writeOutput(histograms, append=(self.mode == 'a'))
+
+    def exportHistos(self, output):
+        histograms = {histo_key: histo.toDict() for histo_key, histo in self.histograms.items()}
+        openStorage(output).write(histograms)
+
+    def _fillHistos(self):
+        with stage('NTupler.fill'):
+            self._fillData()
+
+    def _fillData(self):
+        self._new_histograms = {}
         for key, d in self.data.items():
             new_key, flag = NTupler._trim(key)
             if flag:
@@ -32,7 +118,10 @@ class NTupler:
             else:
                 self._makeCombinedHisto(key, d)
                 self._makeHistoInBins(key, d)
-        
+
+        for histo_key, histo in self._new_histograms.items():
+            self._mergeHisto(histo_key, histo)
+        self._new_histograms = None
 
     @staticmethod
     def _trim(key):
@@ -61,75 +150,105 @@ class NTupler:
         else:
             return self.data_bins[key], self.c_data_bins[f'{comb_key}']
 
-    def _fillHist(self, data, c_data, data_bins, c_data_bins):
-        # Dimension of NTuple depends on type of c_data
-        # c_data = None condition to plot combined plot
-        if c_data is None:
-            return self.histo1D(data, data_bins)
-        elif type(c_data[0]) == np.bool:
-            data = data[c_data]
-            return self.histo1D(data, data_bins)
-        else:
-            return self.histo2D(data, c_data, data_bins, c_data_bins)
-
     def histo1D(self, data, data_bins):
 
-        H, d_bins = np.histogram(data, bins=data_bins)
-        histogram = {
-            "data": H.tolist(),
-            "data_bin_edges": d_bins.tolist()
-        }
-
-        return histogram
-
-    def histo2D(self, data, c_data, data_bins, c_data_bins):
-
-        H, c_bins, d_bins = np.histogram2d(c_data, data, bins=(c_data_bins, data_bins))
-        histogram = {
-            "data": H.tolist(),
-            "data_bin_edges": d_bins.tolist(),
-            "c_data_bin_edges": c_bins.tolist()
-        }
+        histogram = Histogram([self._binEdges(data, data_bins)])
+        histogram.fill(data)
 
         return histogram
 
+    # Number of bins is converted to bin edges between min and max of data.
+    # It is not allowed in streaming mode, because each chunk has its own
+    # min and max.
+    def _binEdges(self, data, bins):
+        if type(bins) != int:
+            return np.asarray(bins, dtype=np.float64)
+        if self.streaming:
+            raise ValueError('number of bins can not be used in streaming mode.'\
+                             + ' Use bin edges instead.')
+        return np.histogram_bin_edges(np.asarray(data, dtype=np.float64), bins)
+
+    # Add a single histogram to output file
     def saveHisto(self, histo_key, histo):
-
-        json_data = self._loadJSON()
-        json_data[histo_key] = histo
-
-        with open(self.output, 'w') as file:
-            json.dump(json_data, file, indent=4)
-
-    def _loadJSON(self):
-
-        if os.path.exists(self.output):
-            with open(self.output, 'r') as file:
-                json_data = json.load(file)
-        else: 
-            json_data = {}
-
-        return json_data
+        self._writeOutput({histo_key: histo.toDict()}, append=True)
+
+    # Histograms of the same fill replace each other, the ones of different
+    # chunks (or NTuplers) are added together
+    def _storeHisto(self, histo_key, histo):
+        self._new_histograms[histo_key] = histo
+
+    def _mergeHisto(self, histo_key, histo):
+        if histo_key not in self.histograms:
+            self.histograms[histo_key] = histo
+        elif not self.histograms[histo_key].hasSameEdges(histo):
+            raise ValueError(f'histogram {histo_key} has different bin edges in'\
+                             + ' different chunks')
+        else:
+            self.histograms[histo_key].merge(histo)
+
+    # Output file is replaced atomically by the storage (see Storage.py)
+    def _writeOutput(self, histograms, append=False):
+        with stage('NTupler.write'):
+            self._writeStorage(histograms, append)
+
+    def _writeStorage(self, histograms, append):
+        storage = openStorage(self.output)
+        if append:
+            with open(self._lockPath(), 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                stored_histograms = storage.read()
+                stored_histograms.update(histograms)
+                storage.write(stored_histograms)
+        else:
+            storage.write(histograms)
+
+    def _lockPath(self):
+        # lock is removed neither after use (another process may be waiting
+        # on it) nor written next to output: named by hash of output path
+        lock_dir = os.path.join(os.environ.get('TICL_VALIDATION_CACHE',\
+                                os.path.join(os.path.expanduser('~'), '.cache',\
+                                             'ticl_validation')), 'locks')
+        os.makedirs(lock_dir, exist_ok=True)
+        output = os.path.realpath(self.output)
+        return os.path.join(lock_dir, hashlib.sha1(output.encode()).hexdigest() + '.lock')
 
     def _makeHistoInBins(self, data_key, data, key_to_save=None, mapping_data=None):
+        if key_to_save is None:
+            key_to_save = data_key
 
-        combination_keys = ['E', 'ET', 'eta', 'HD', 'LD']
-        if mapping_data is not None:
-            for comb_key in combination_keys:
-                c_data = self.combination_data[f'{data_key}_{comb_key}'][mapping_data]
-                data_bins, c_data_bins = self._extractBins(data_key, comb_key)
-                histo = self._fillHist(data, c_data, data_bins, c_data_bins)
-                self.saveHisto(f'{key_to_save}_{comb_key}', histo)
-        else:
-            for comb_key in combination_keys:
-                c_data = self.combination_data[f'{data_key}_{comb_key}']
-                data_bins, c_data_bins = self._extractBins(data_key, comb_key)
-                histo = self._fillHist(data, c_data, data_bins, c_data_bins)
-                self.saveHisto(f'{data_key}_{comb_key}', histo)
+        data_bins = self._extractBins(data_key, comb_key=None)
+        c_arrays, c_edges = [], []
+        for comb_key in NTupler.combination_keys:
+            c_data = np.asarray(self.combination_data[f'{data_key}_{comb_key}'])
+            if mapping_data is not None:
+                c_data = c_data[mapping_data]
+            # masks have fixed bins, c_data_bins are not needed for them
+            if c_data.dtype == bool:
+                c_edges.append(NTupler.mask_edges)
+            else:
+                c_data_bins = self._extractBins(data_key, comb_key)[1]
+                c_edges.append(self._binEdges(c_data, c_data_bins))
+            c_arrays.append(c_data)
+
+        # all the combination keys are filled in one pass
+        histo = SparseHistogram(c_edges + [self._binEdges(data, data_bins)],\
+                                names=NTupler.combination_keys + ['data'])
+        histo.fill(*c_arrays, data)
+
+        if self.nd_histos:
+            self._storeHisto(f'{key_to_save}_nd', histo)
+            return
+
+        for comb_key, c_data in zip(NTupler.combination_keys, c_arrays):
+            if c_data.dtype == bool and type(data_bins) == int:
+                # number of bins is taken in the range of masked data
+                histo_in_bins = self.histo1D(data[c_data], data_bins)
+            else:
+                histo_in_bins = NTupler.projectHisto(histo, comb_key)
+            self._storeHisto(f'{key_to_save}_{comb_key}', histo_in_bins)
 
     def _makeCombinedHisto(self, data_key, data):
         
         data_bins = self._extractBins(data_key, comb_key=None)
-        histo = self._fillHist(data, c_data=None, data_bins=data_bins, c_data_bins=None)
-        self.saveHisto(data_key, histo)
+        self._storeHisto(data_key, self.histo1D(data, data_bins))
 
@@ -0,0 +1,71 @@
+# This file contains a planner of reads shared by several processors.
+#
+# Each processor lists the columns (branch_name, key) it needs in columns().
+# Planner takes the union of the columns of all the processors of a run and
+# reads each of them exactly once. The planned reads (DataChunk) are then
+# given to each processor instead of the DataFile:
+#       planner = Planner([Multiplicity(), Combination(), Efficiency()])
+#       planner.getData(data)                  # fills self.data of processors
+#       for chunks_data in planner.iterData(data, step_size):
+#           ...                                # list of data of each processor
+#
+# If layer_map=True, zToIDMap() is computed once from the shared read of
+# ticlDumper/clusters;1 (unless the map of the geometry is already stored)
+# and is given to all the processors, so that they can use zToLayerID().
+from typing import List
+from .DataFile import DataChunk
+from .DataProcessor import DataProcessor
+
+class Planner:
+    def __init__(self, processors: List[DataProcessor], layer_map: bool = False):
+        self.processors = processors
+        self.layer_map = layer_map
+
+    # Union of the columns of all the processors in the order of appearance.
+    # Clusters are added if zToIDMap() has to be computed for data
+    def columns(self, data=None):
+        columns = []
+        for processor in self.processors:
+            columns += processor.columns()
+        if self.layer_map and data is not None and not self._hasMap(data):
+            columns += DataProcessor.map_columns
+        return list(dict.fromkeys(columns))
+
+    # Reads all the planned columns of data (DataFile) at once. Returns DataChunk
+    # with all the events
+    def read(self, data):
+        arrays = data.openArrays(self.columns(data), cache=False)
+        return DataChunk(arrays, 0, data.nevents, data.filepath)
+
+    # Fills self.data of each processor from one shared read. Processors found
+    # in the disk cache of data (see DiskCache) are not a part of the read
+    def getData(self, data):
+        processors = [processor for processor in self.processors\
+                      if processor.data is None and not processor.loadCache(data)]
+        planned_data = Planner(processors, self.layer_map).read(data)
+        if self.layer_map:
+            self._shareMap(planned_data)
+        for processor in processors:
+            processor.getData(planned_data)
+            processor.saveCache(data)
+        return planned_data
+
+    # Yields a list of data of each processor for each chunk of events. The map
+    # is computed from the whole file before the first chunk
+    def iterData(self, data, step_size=100000):
+        if self.layer_map:
+            self._shareMap(data)
+        # clusters are not needed in chunks: the map is already shared
+        for chunk in data.iterate(self.columns(), step_size):
+            yield [processor.chunkData(chunk) for processor in self.processors]
+
+    def _hasMap(self, data):
+        return DataProcessor.hasMap(DataProcessor._findGeometry(data.filepath))
+
+    def _shareMap(self, data):
+        map_processor = DataProcessor()
+        map_processor.zToIDMap(data)
+        for processor in self.processors:
+            processor.zToID = map_processor.zToID
+            processor.maxID = map_processor.maxID
+        return 0
@@ -1,12 +1,32 @@
 # In this file, there is a class required to produce plots
-# of given NTuples. For now, it only reads the .json files
+# of given NTuples. Input may be either .json or .npz file (see Storage.py),
+# histograms of .npz files are loaded only when they are plotted.
+#
+# makePlots() renders histograms in a pool of `workers` processes. A hash of
+# the content of each histogram is stored in output directory
+# (.plot_hashes.json), histograms which did not change since the last call
+# are not plotted again (unless force=True).
+#
+# All the plots of one Plotter are drawn on a single figure, which is cleared
+# before each plot and closed at the end of makePlots().
+#
+# N-dimensional histograms (e.g. {key}_nd of NTupler with nd_histos=True) are
+# not plotted as they are: 2D views {key}_{axis} (1D for masks) are projected
+# from them on demand and plotted as usual 2D (and unrolled) histograms.
 #!!! in principle, it might be improoved if needed!!!
+import hashlib
 import json
+import os
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from typing import Union, List, Dict
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 import mplhep as hep
+from .Storage import openStorage
+from .Histogram import Histogram
+from .NTupler import NTupler
+from .Profiler import stage, runProfiled, mergeTrace
 
 class Plotter:
     # setting up dpi=300 for all plots
@@ -19,6 +39,7 @@ class Plotter:
         self.output = output
         self.file = None
         self.prefix = None
+        self.figure = None
         self.hist1D_x_labels = {
             'multiplicity': {
                                 'LC': '# of LC in trackster',
@@ -34,7 +55,16 @@ class Plotter:
                     },
             'efficiency': {
                             'LC': 'trackster to CP score',
-                            'Tracksters': 'supercluster to CP score'
+                            'Tracksters': 'supercluster to CP score',
+                            'E': 'CP energy [GeV]',
+                            'eta': r'CP $|\eta|$'
+                    },
+            'displacement': {
+                            'Candidates': 'centroid displacement from sim axis [cm]'
+                    },
+            'pca': {
+                        'LC': r'$|\theta_\text{sim} - \theta_\text{reco}|$',
+                        'Tracksters': r'$|\theta_\text{sim} - \theta_\text{reco}|$'
                     }
         }
         self.readJSON()
@@ -47,22 +77,65 @@ class Plotter:
 
     def readJSON(self):
         if self.file is None:
-            with open(self.input, 'r') as file:
-                self.file = json.load(file)
+            self.file = openStorage(self.input)
     
-    def makePlots(self):
+    def makePlots(self, workers: int = None, force: bool = False):
         # This function makes all the plots from a given input file.
+        # Only the histograms changed since the previous call are plotted.
+
+        hashes = {hist_name: Plotter._histHash(hist) for hist_name, hist in self.file.items()}
+        stored_hashes = self._loadHashes()
+        hist_names = [hist_name for hist_name, hist_hash in hashes.items()\
+                      if force or stored_hashes.get(self._plotName(hist_name)) != hist_hash\
+                      or not self._isPlotted(hist_name)]
+
+        if workers is None:
+            workers = os.cpu_count()
+        workers = min(workers, len(hist_names))
+
+        if workers <= 1:
+            for hist_name in hist_names:
+                self.plotHist(hist_name)
+            self.closeFigure()
+        else:
+            tasks = [hist_names[i::workers] for i in range(workers)]
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(runProfiled, [_plotHists] * workers,\
+                                            [self.input] * workers, [self.output] * workers,\
+                                            tasks))
+            for _, trace in results:
+                mergeTrace(trace)
+
+        for hist_name in hist_names:
+            stored_hashes[self._plotName(hist_name)] = hashes[hist_name]
+        self._saveHashes(stored_hashes)
+
+    def plotHist(self, hist_name: str):
+        with stage('Plotter.plotHist'):
+            self._plotHist(hist_name)
+
+    def _plotHist(self, hist_name: str):
         # There may be 1D and 2D histograms. They are easily distinguished
-        # by checking a data type of the first element of the list:
-        #       1. type(data[0]) == list -> 2D histogram
-        #       2. type(data[0]) == float -> 1D histogram
+        # by checking a number of dimensions of data
+        hist = self.file[hist_name]
+        if Histogram.isMultiDim(hist):
+            for axis in range(Histogram.fromDict(hist).ndim - 1):
+                view_name, view = self._view(hist_name, hist, axis)
+                if np.ndim(view['data']) == 1:
+                    self.hist1D(view_name, view)
+                else:
+                    self.hist2D(view_name, view)
+                    self.unrolledHist(hist_name, hist, axis=axis)
+        elif np.ndim(hist['data']) == 1:
+            self.hist1D(hist_name, hist)
+        else:
+            self.hist2D(hist_name, hist)
+            self.unrolledHist(hist_name, hist)
 
-        for hist_name, hist in self.file.items():
-            if type(hist['data'][0]) == int:
-                self.hist1D(hist_name, hist)
-            else:
-                self.hist2D(hist_name, hist)
-                self.unrolledHist(hist_name, hist)
+    def closeFigure(self):
+        if self.figure is not None:
+            plt.close(self.figure)
+            self.figure = None
 
     def hist1D(self, hist_name: str, hist: Dict[str, List[Union[List, int]]],\
                 scale: str ='log', comb_bin_min: float = None,\
@@ -73,9 +146,9 @@ class Plotter:
         data, bar_centers, bar_widths = self._defineHist(hist, scale, bin_num)
         label = self._setLabel(comb_bin_min, comb_bin_max, comb_var)
 
-        fig, ax = plt.subplots()
+        fig, ax = self._getFigure()
         ax.bar(bar_centers, data, width=bar_widths, label=label)
-        hep.cms.label('Internal', loc=0, com=None)
+        hep.cms.label('Internal', loc=0, com=None, ax=ax)
         
         # when log-scale we change y_ticks
         if scale == 'log':
@@ -84,16 +157,18 @@ class Plotter:
 
         # setting up labels
         ax.set_ylabel('Counts')
-        ax.set_xlabel(self.hist1D_x_labels[self.input.split('_')[0]][hist_name.split('_')[0]])
+        ax.set_xlabel(self._xLabel(hist_name))
         
         #setting up legend
         ax.legend()
         
         #saving plot inside self.output directory
         if bin_num is None:
-            plt.savefig(f'{self.output}/{self.prefix}_{hist_name}.svg')
+            path = f'{self.output}/{self._plotName(hist_name)}.svg'
         else:
-            plt.savefig(f'{self.output}/{self.prefix}_{hist_name}_{bin_num}.svg')
+            path = f'{self.output}/{self._plotName(hist_name)}_{bin_num}.svg'
+        with stage('Plotter.savefig'):
+            fig.savefig(path)
 
     def hist2D(self, hist_name: str, hist: Dict[str,List[Union[List, int]]], scale: str='log'):
         data_edges, c_bin_edges = hist['data_bin_edges'], hist['c_data_bin_edges']
@@ -102,9 +177,9 @@ class Plotter:
         else:
             data = hist['data']
 
-        fig, ax = plt.subplots()
+        fig, ax = self._getFigure()
         im = ax.imshow(data)
-        hep.cms.label("Internal", loc=0, com=None)
+        hep.cms.label("Internal", loc=0, com=None, ax=ax)
         x_ticks, y_ticks = self._getHist2DTicks(hist_name, hist)
         ax.set_xticks(x_ticks[0], x_ticks[1])
         ax.set_yticks(y_ticks[0], y_ticks[1])
@@ -113,21 +188,101 @@ class Plotter:
         if scale == 'log':
             cbar.set_ticklabels([f'$10^{{{i}}}$' for i in cbar.get_ticks()])
 
-        ax.set_ylabel(hist_name.split('_')[-1])
-        ax.set_xlabel(self.hist1D_x_labels[self.prefix][hist_name.split('_')[0]])
+        ax.set_ylabel(self._combVar(hist_name))
+        ax.set_xlabel(self._xLabel(hist_name))
         
-        plt.savefig(f'{self.output}/{self.prefix}_{hist_name}.svg')
+        with stage('Plotter.savefig'):
+            fig.savefig(f'{self.output}/{self._plotName(hist_name)}.svg')
 
-    def unrolledHist(self, hist_name: str, hist: Dict[str, List[Union[List, int]]], scale: str = 'log'):
-        # This function unrolls a given 2D histogram
+    def unrolledHist(self, hist_name: str, hist: Dict[str, List[Union[List, int]]], scale: str = 'log',\
+                     axis: int = None):
+        # This function unrolls a given 2D histogram. For N-dimensional
+        # histogram the 2D view of axis is unrolled
+        if Histogram.isMultiDim(hist):
+            hist_name, hist = self._view(hist_name, hist, axis)
         n_unrolling_bins = len(hist['data'])
         for bin in range(n_unrolling_bins):
             comb_bin_min = np.round(hist['c_data_bin_edges'][bin], 2)
             comb_bin_max = np.round(hist['c_data_bin_edges'][bin + 1], 2)
-            comb_var = hist_name.split('_')[-1]
+            comb_var = self._combVar(hist_name)
 
             self.hist1D(hist_name, hist, scale, comb_bin_min, comb_bin_max, comb_var, bin)
 
+    # Returns the figure of the Plotter (created once) with a single empty axes
+    def _getFigure(self):
+        if self.figure is None:
+            self.figure = plt.figure()
+        else:
+            self.figure.clear()
+        ax = self.figure.add_subplot()
+        return self.figure, ax
+
+    # Label of data axis is chosen by the first part of histogram name (e.g.
+    # LC), histograms of Efficiency ({name}_{var}_...) by the binning variable
+    def _xLabel(self, hist_name: str):
+        labels = self.hist1D_x_labels[self.prefix]
+        name_parts = hist_name.split('_')
+        if len(name_parts) > 1 and name_parts[1] in labels:
+            return labels[name_parts[1]]
+        return labels[name_parts[0]]
+
+    # Combination variable (first axis) of 2D histogram is the last part of its
+    # name (e.g. eta of LC_reco_eta). Histograms of Response
+    # ({name}_{region}_th_{threshold}) are binned in generated energy
+    def _combVar(self, hist_name: str):
+        if self.prefix == 'response' and '_th_' in hist_name:
+            return 'E_gen'
+        return hist_name.split('_')[-1]
+
+    def _plotName(self, hist_name: str):
+        return f'{self.prefix}_{hist_name}'
+
+    def _isPlotted(self, hist_name: str):
+        hist = self.file[hist_name]
+        if Histogram.isMultiDim(hist):
+            hist_name = self._view(hist_name, hist, 0)[0]
+        return os.path.exists(f'{self.output}/{self._plotName(hist_name)}.svg')
+
+    # Returns name and dictionary of a 2D (or 1D for masks) view of axis of
+    # N-dimensional histogram. The last axis is data
+    def _view(self, hist_name: str, hist: Dict[str, List], axis: int):
+        if hist_name.endswith('_nd'):
+            hist_name = hist_name[:-len('_nd')]
+
+        histo = Histogram.fromDict(hist)
+        if getattr(histo, 'names', None) is not None:
+            # combination keys of NTupler (with masks)
+            axis_name = histo.names[axis]
+            view = NTupler.projectHisto(histo, axis_name)
+        else:
+            axis_name = str(axis)
+            view = histo.project(axis, histo.ndim - 1)
+        return f'{hist_name}_{axis_name}', view.toDict()
+
+    # Hash of histogram content (counts and bin edges)
+    @staticmethod
+    def _histHash(hist: Dict[str, List]):
+        hist_hash = hashlib.sha1()
+        for key in sorted(hist.keys()):
+            array = np.ascontiguousarray(hist[key])
+            hist_hash.update(f'{key}:{array.dtype}:{array.shape}'.encode())
+            hist_hash.update(array.tobytes())
+        return hist_hash.hexdigest()
+
+    def _loadHashes(self):
+        path = f'{self.output}/.plot_hashes.json'
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                return json.load(file)
+        return {}
+
+    def _saveHashes(self, hashes: Dict[str, str]):
+        path = f'{self.output}/.plot_hashes.json'
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(hashes, file, indent=4)
+        os.replace(tmp_path, path)
+
     def _getHist2DTicks(self, hist_name: str, hist: Dict[str, List[float]]):
         x_tick_positions = np.linspace(-0.5, 9.5, 9)
         data_bin_ids = np.linspace(0, len(hist['data_bin_edges']), 9)
@@ -165,5 +320,16 @@ class Plotter:
             return comb_var
         elif comb_var == 'eta':
             return f'{comb_bin_min} < {comb_var} < {comb_bin_max}'
+        elif comb_var == 'E_gen':
+            return f'{comb_bin_min} < $E_{{gen}}$ < {comb_bin_max} GeV'
         else:
-            return f'{comb_bin_min} < {comb_var} < {comb_bin_max} MeV'
\ No newline at end of file
+            return f'{comb_bin_min} < {comb_var} < {comb_bin_max} MeV'
+
+# Worker of Plotter.makePlots(). Each process opens input on its own and plots
+# only hist_names
+def _plotHists(input: str, output: str, hist_names: List[str]):
+    plotter = Plotter(input, output)
+    for hist_name in hist_names:
+        plotter.plotHist(hist_name)
+    plotter.closeFigure()
+    return 0
@@ -0,0 +1,210 @@
+# This file contains profiling instrumentation of DataFile, processors, NTupler
+# and Plotter.
+#
+# Profiling is off by default. It is enabled either by the environment variable
+#       TICL_VALIDATION_PROFILE=1            # table is printed at exit
+#       TICL_VALIDATION_PROFILE=trace.json   # JSON trace is written at exit
+# or by the context manager
+#       with profiling() as profile:         # or profiling('trace.json')
+#           ...
+#       print(profile.report())
+#
+# The following is recorded:
+#       stages   - number of calls, total time and peak memory (traced by
+#                  tracemalloc) of each stage (e.g. 'Combination.getData',
+#                  'NTupler.write', 'Plotter.savefig')
+#       counters - e.g. number of DataFile.openArray() calls
+#       bytes    - in-memory size (nbytes) of arrays read from each branch,
+#                  i.e. of decompressed arrays, not bytes read from the file
+# report() returns a table, trace() returns a dictionary in Chrome trace event
+# format (can be opened by chrome://tracing or Perfetto) with the summary.
+#
+# When profiling is off stage() returns one shared empty context manager and
+# count() and addBytes() return immediately, so instrumentation costs almost
+# nothing.
+#
+# Worker processes (e.g. of Plotter.makePlots(), Response.fit() or Runner) end
+# without running atexit handlers, so they never report on their own. Tasks of
+# workers are run by runProfiled(), which returns the trace of the task
+# together with its result, and the main process adds it to its profile with
+# mergeTrace(). Workers are profiled if the main process is profiled when they
+# are started (by the environment variable or, with forked workers, by the
+# context manager).
+import atexit
+import contextlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+class Profile:
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self.bytes = {}
+        self.events = []
+        self._stack = []
+        self._start = time.perf_counter()
+        self._tracing = not tracemalloc.is_tracing()
+        if self._tracing:
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        # peak of the outer stage is saved before the peak is reset
+        if len(self._stack) > 0:
+            self._stack[-1]['peak'] = max(self._stack[-1]['peak'], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        frame = {'start_memory': current, 'peak': current}
+        self._stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            self._stack.pop()
+            frame['peak'] = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+            if len(self._stack) > 0:
+                self._stack[-1]['peak'] = max(self._stack[-1]['peak'], frame['peak'])
+            self._record(name, start, duration, frame['peak'] - frame['start_memory'])
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def addBytes(self, branch_name: str, nbytes: int):
+        self.bytes[branch_name] = self.bytes.get(branch_name, 0) + nbytes
+
+    # Adds trace() of another Profile (e.g. of a worker process)
+    def merge(self, trace):
+        for name, other in trace['stages'].items():
+            stage = self.stages.setdefault(name, {'calls': 0, 'time': 0., 'peak': 0})
+            stage['calls'] += other['calls']
+            stage['time'] += other['time']
+            stage['peak'] = max(stage['peak'], other['peak'])
+        for name, value in trace['counters'].items():
+            self.count(name, value)
+        for branch_name, nbytes in trace['bytes'].items():
+            self.addBytes(branch_name, nbytes)
+        self.events += trace['traceEvents']
+
+    def stop(self):
+        if self._tracing and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self._tracing = False
+
+    def report(self):
+        lines = [f'{"stage":<45} {"calls":>7} {"time [s]":>10} {"peak memory [MB]":>17}']
+        for name, stage in sorted(self.stages.items(), key=lambda item: -item[1]['time']):
+            lines.append(f'{name:<45} {stage["calls"]:>7} {stage["time"]:>10.3f}'\
+                         + f' {stage["peak"]/2**20:>17.1f}')
+        if len(self.counters) > 0:
+            lines += ['', f'{"counter":<45} {"value":>7}']
+            lines += [f'{name:<45} {value:>7}' for name, value in sorted(self.counters.items())]
+        if len(self.bytes) > 0:
+            lines += ['', f'{"branch":<45} {"in memory [MB]":>15}']
+            lines += [f'{name:<45} {nbytes/2**20:>15.1f}'\
+                      for name, nbytes in sorted(self.bytes.items())]
+        return '\n'.join(lines)
+
+    def trace(self):
+        return {
+            'traceEvents': self.events,
+            'stages': self.stages,
+            'counters': self.counters,
+            'bytes': self.bytes
+        }
+
+    def save(self, output: str):
+        with open(output, 'w') as file:
+            json.dump(self.trace(), file, indent=4)
+
+    def _record(self, name, start, duration, peak):
+        stage = self.stages.setdefault(name, {'calls': 0, 'time': 0., 'peak': 0})
+        stage['calls'] += 1
+        stage['time'] += duration
+        stage['peak'] = max(stage['peak'], peak)
+        self.events.append({
+            'name': name,
+            'ph': 'X',
+            'ts': (start - self._start)*1e6,
+            'dur': duration*1e6,
+            'pid': os.getpid(),
+            'tid': 0,
+            'args': {'peak_memory': peak}
+        })
+
+_profile = None
+_null_stage = contextlib.nullcontext()
+
+def enabled():
+    return _profile is not None
+
+def stage(name: str):
+    if _profile is None:
+        return _null_stage
+    return _profile.stage(name)
+
+def count(name: str, n: int = 1):
+    if _profile is not None:
+        _profile.count(name, n)
+
+def addBytes(branch_name: str, nbytes: int):
+    if _profile is not None:
+        _profile.addBytes(branch_name, nbytes)
+
+# Runs function(*args) in a worker process. Returns its result and the trace of
+# the task (None if profiling is off), to be given to mergeTrace() in the main
+# process
+def runProfiled(function, *args):
+    global _profile
+    if _profile is None:
+        return function(*args), None
+
+    # a forked worker has a copy of the profile of the main process, it is
+    # replaced, so that stages of the main process are not counted twice
+    previous, _profile = _profile, Profile()
+    profile = _profile
+    try:
+        result = function(*args)
+    finally:
+        _profile = previous
+        profile.stop()
+    return result, profile.trace()
+
+def mergeTrace(trace):
+    if _profile is not None and trace is not None:
+        _profile.merge(trace)
+
+# output is None (table is printed) or path of JSON trace
+@contextlib.contextmanager
+def profiling(output: str = None):
+    global _profile
+    previous, _profile = _profile, Profile()
+    profile = _profile
+    try:
+        yield profile
+    finally:
+        _profile = previous
+        profile.stop()
+        _report(profile, output)
+
+def _report(profile, output):
+    if output is None:
+        print(profile.report(), file=sys.stderr)
+    else:
+        profile.save(output.format(pid=os.getpid()))
+
+# Only the process which registered the handler reports
+def _reportAtExit(profile, output, pid):
+    if os.getpid() != pid:
+        return
+    profile.stop()
+    _report(profile, output)
+
+_env_output = os.environ.get('TICL_VALIDATION_PROFILE', '0')
+if _env_output != '0':
+    _profile = Profile()
+    atexit.register(_reportAtExit, _profile, None if _env_output == '1' else _env_output,\
+                    os.getpid())
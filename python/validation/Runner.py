@@ -0,0 +1,144 @@
+# Command line entry point to run validation over many dumper files in
+# parallel. Run from python/ directory:
+#
+#       python -m validation.Runner --files '/path/to/*/dumper_merged.root' \
+#           --processors Multiplicity --bins bins.json --workers 16
+#
+# Files (or globs) are split into tasks of --files-per-task files. Each task is
+# processed in a separate worker process chunk by chunk (see
+# DataFile.iterate()). Histograms of all the tasks are merged and written once
+# into --output per processor ('{processor}' is replaced by the lower case
+# name of the processor, so that Plotter recognizes the type of the NTuples).
+#
+# Histograms of different workers can be merged only if they have the same
+# bin edges, so bins have to be given as bin edges in a .json file:
+#       {"data_bins": {"LC_reco": [...], ...},
+#        "c_data_bins": {"E": [...], "ET": [...], "eta": [...]}}
+# (see NTupler for all the possible forms of data_bins and c_data_bins). Masks
+# HD and LD have fixed bins and need no c_data_bins.
+#
+# Only processors whose data is histogrammed by NTupler in bins of a
+# combination (for now Multiplicity with Combination) are supported. The other
+# processors (Efficiency, Response, ...) fill their own histograms, use their
+# saveHistos() or Planner.iterData() for them.
+import argparse
+import glob
+import json
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Union
+from .DataFile import DataFile
+from .DataProcessor import Multiplicity, Combination
+from .NTupler import NTupler
+from .Planner import Planner
+from .Profiler import runProfiled, mergeTrace
+
+# processors producing data for NTupler in bins of COMBINATIONS
+PROCESSORS = {
+    'Multiplicity': Multiplicity
+}
+
+COMBINATIONS = {
+    'Combination': Combination
+}
+
+def expandFiles(patterns: List[str]):
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if len(matches) == 0:
+            raise FileNotFoundError(f'no files match {pattern}')
+        for match in matches:
+            if match not in files:
+                files.append(match)
+    return files
+
+def makeTasks(files: List[str], files_per_task: int = 1):
+    return [files[i:i + files_per_task] for i in range(0, len(files), files_per_task)]
+
+# Runs one processor over a list of files in the current process and returns
+# NTupler with accumulated histograms
+def processFiles(filepaths: List[str], processor: str, combination: str = 'Combination',
+                 data_bins=None, c_data_bins=None, step_size: Union[int, str] = 100000):
+    ntupler = NTupler(None, None, data_bins, c_data_bins)
+    for filepath in filepaths:
+        data = DataFile(filepath, cache_size=0)
+        # columns of both processors are read once per chunk
+        planner = Planner([PROCESSORS[processor](), COMBINATIONS[combination]()])
+        step_entries = data.stepEntries(planner.columns(), step_size)
+        for chunk_data, chunk_c_data in planner.iterData(data, step_entries):
+            ntupler.fillChunk(chunk_data, chunk_c_data)
+
+    # only histograms are sent back to the main process
+    ntupler.data = None
+    ntupler.combination_data = None
+    return ntupler
+
+def run(files: List[str], processors: List[str], combination: str = 'Combination',
+        data_bins=None, c_data_bins=None, output: str = '{processor}_ntuple.json',
+        workers: int = None, files_per_task: int = 1, step_size: Union[int, str] = 100000):
+    for processor in processors:
+        if processor not in PROCESSORS:
+            raise KeyError(f'processor = {processor} is unavailable. Available'\
+                           + f' processors: {list(PROCESSORS.keys())}')
+    if combination not in COMBINATIONS:
+        raise KeyError(f'combination = {combination} is unavailable. Available'\
+                       + f' combinations: {list(COMBINATIONS.keys())}')
+
+    tasks = makeTasks(expandFiles(files), files_per_task)
+    ntuplers = {processor: NTupler(None, None, data_bins, c_data_bins,\
+                                   output.format(processor=processor.lower()))\
+                for processor in processors}
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for processor in processors:
+            for task in tasks:
+                future = executor.submit(runProfiled, processFiles, task, processor,\
+                                         combination, data_bins, c_data_bins, step_size)
+                futures.append((processor, future))
+
+        for processor, future in futures:
+            ntupler, trace = future.result()
+            ntuplers[processor].merge(ntupler)
+            mergeTrace(trace)
+
+    for ntupler in ntuplers.values():
+        ntupler.saveHistos()
+
+    return ntuplers
+
+def _stepSize(step_size: str):
+    if step_size.isdigit():
+        return int(step_size)
+    return step_size
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run TICL validation over many dumper files')
+    parser.add_argument('--files', nargs='+', required=True,\
+                        help='dumper ROOT files or glob patterns')
+    parser.add_argument('--processors', nargs='+', default=['Multiplicity'],\
+                        choices=list(PROCESSORS.keys()),\
+                        help='processors histogrammed in bins of --combination (only'\
+                        + ' Multiplicity is supported for now)')
+    parser.add_argument('--combination', default='Combination',\
+                        choices=list(COMBINATIONS.keys()))
+    parser.add_argument('--bins', required=True,\
+                        help='.json file with data_bins and c_data_bins (bin edges)')
+    parser.add_argument('--output', default='{processor}_ntuple.json',\
+                        help='output file (.json or .npz), {processor} is replaced'\
+                        + ' by the name of processor')
+    parser.add_argument('--workers', type=int, default=None,\
+                        help='number of worker processes (default: number of cores)')
+    parser.add_argument('--files-per-task', type=int, default=1)
+    parser.add_argument('--step-size', type=_stepSize, default=100000,\
+                        help='number of events or memory size (e.g. "100 MB") of a chunk')
+    args = parser.parse_args(argv)
+
+    with open(args.bins, 'r') as file:
+        bins = json.load(file)
+
+    run(args.files, args.processors, args.combination, bins['data_bins'], bins['c_data_bins'],\
+        args.output, args.workers, args.files_per_task, args.step_size)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+# This file contains a compiler of selection strings used by processors
+# (e.g. Combination), like
+#       'raw_energy'
+#       'barycenter_eta < 2.02'
+#       '(abs(barycenter_eta) > 1.9) & (abs(barycenter_eta) < 2.1)'
+#
+# Selection compiles a dictionary {name: expression} once. Expressions are
+# made of keys of a branch, numbers, arithmetic (+, -, *, /), comparisons
+# (<, <=, >, >=, ==, !=), logical operations (&, |, ~), abs() and brackets.
+#
+# Use columns() to get the set of keys needed by all the expressions, so that
+# they can be read at once (see DataFile.openArrays()), and evaluate() to
+# compute all the expressions in one pass. Sub-expressions shared between
+# expressions (e.g. abs(barycenter_eta)) are computed only once.
+#
+# Compiled expressions are nested tuples:
+#       ('key', name), ('number', value), ('abs', node), ('~', node),
+#       (operator, left_node, right_node)
+import re
+import operator
+import numpy as np
+from typing import Dict
+
+class Selection:
+    token_pattern = re.compile(r'\s*(?:(\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?)'\
+                               + r'|([A-Za-z_]\w*)|(<=|>=|==|!=|[<>&|~()+\-*/]))')
+
+    operators = {
+        '<': operator.lt,
+        '<=': operator.le,
+        '>': operator.gt,
+        '>=': operator.ge,
+        '==': operator.eq,
+        '!=': operator.ne,
+        '&': np.logical_and,
+        '|': np.logical_or,
+        '+': operator.add,
+        '-': operator.sub,
+        '*': operator.mul,
+        '/': operator.truediv
+    }
+
+    def __init__(self, expressions: Dict[str, str]):
+        self.expressions = expressions
+        self.plan = {name: Selection.compile(expression)\
+                     for name, expression in expressions.items()}
+
+    def columns(self):
+        keys = set()
+        for node in self.plan.values():
+            Selection._collectKeys(node, keys)
+        return keys
+
+    # arrays is a dictionary {key: array} containing all the columns(). Returns
+    # a dictionary {name: result of expression}
+    def evaluate(self, arrays):
+        computed = {}
+        return {name: Selection._evaluate(node, arrays, computed)\
+                for name, node in self.plan.items()}
+
+    @staticmethod
+    def compile(expression: str):
+        tokens = Selection._tokenize(expression)
+        node, position = Selection._parseOr(tokens, 0)
+        if position != len(tokens):
+            raise ValueError(f'unexpected {tokens[position][1]} in selection: {expression}')
+        return node
+
+    # computed contains already computed nodes of the current evaluation
+    @staticmethod
+    def _evaluate(node, arrays, computed):
+        if node in computed:
+            return computed[node]
+
+        if node[0] == 'key':
+            result = arrays[node[1]]
+        elif node[0] == 'number':
+            result = node[1]
+        elif node[0] == 'abs':
+            result = np.abs(Selection._evaluate(node[1], arrays, computed))
+        elif node[0] == '~':
+            result = np.logical_not(Selection._evaluate(node[1], arrays, computed))
+        else:
+            left = Selection._evaluate(node[1], arrays, computed)
+            right = Selection._evaluate(node[2], arrays, computed)
+            result = Selection.operators[node[0]](left, right)
+
+        computed[node] = result
+        return result
+
+    @staticmethod
+    def _collectKeys(node, keys):
+        if node[0] == 'key':
+            keys.add(node[1])
+        elif node[0] != 'number':
+            for child in node[1:]:
+                Selection._collectKeys(child, keys)
+        return keys
+
+    # Returns a list of (type, value) tokens, type is 'number', 'name' or 'op'
+    @staticmethod
+    def _tokenize(expression: str):
+        tokens = []
+        position = 0
+        expression = expression.rstrip()
+        while position < len(expression):
+            match = Selection.token_pattern.match(expression, position)
+            if match is None:
+                raise ValueError(f'unexpected symbol {expression[position:].strip()[0]}'\
+                                 + f' in selection: {expression}')
+            number, name, op = match.groups()
+            if number is not None:
+                tokens.append(('number', float(number)))
+            elif name is not None:
+                tokens.append(('name', name))
+            else:
+                tokens.append(('op', op))
+            position = match.end()
+        return tokens
+
+    # Recursive descent parser. Each _parse* method returns (node, position of
+    # the next token). Precedence: | < & < ~ < comparison < +- < */ < unary -
+    @staticmethod
+    def _parseOr(tokens, position):
+        return Selection._parseBinary(tokens, position, ['|'], Selection._parseAnd)
+
+    @staticmethod
+    def _parseAnd(tokens, position):
+        return Selection._parseBinary(tokens, position, ['&'], Selection._parseNot)
+
+    @staticmethod
+    def _parseNot(tokens, position):
+        if Selection._isOp(tokens, position, ['~']):
+            node, position = Selection._parseNot(tokens, position + 1)
+            return ('~', node), position
+        return Selection._parseComparison(tokens, position)
+
+    @staticmethod
+    def _parseComparison(tokens, position):
+        return Selection._parseBinary(tokens, position, ['<', '<=', '>', '>=', '==', '!='],\
+                                      Selection._parseSum, repeat=False)
+
+    @staticmethod
+    def _parseSum(tokens, position):
+        return Selection._parseBinary(tokens, position, ['+', '-'], Selection._parseProduct)
+
+    @staticmethod
+    def _parseProduct(tokens, position):
+        return Selection._parseBinary(tokens, position, ['*', '/'], Selection._parseAtom)
+
+    @staticmethod
+    def _parseBinary(tokens, position, ops, parse_operand, repeat=True):
+        node, position = parse_operand(tokens, position)
+        while Selection._isOp(tokens, position, ops):
+            op = tokens[position][1]
+            right, position = parse_operand(tokens, position + 1)
+            node = (op, node, right)
+            if not repeat:
+                break
+        return node, position
+
+    @staticmethod
+    def _parseAtom(tokens, position):
+        if position >= len(tokens):
+            raise ValueError('unexpected end of selection')
+
+        token_type, value = tokens[position]
+        if token_type == 'number':
+            return ('number', value), position + 1
+        if Selection._isOp(tokens, position, ['-']):
+            node, position = Selection._parseAtom(tokens, position + 1)
+            return ('-', ('number', 0.), node), position
+        if Selection._isOp(tokens, position, ['(']):
+            node, position = Selection._parseOr(tokens, position + 1)
+            return node, Selection._expectClosing(tokens, position)
+        if token_type == 'name' and value == 'abs':
+            if not Selection._isOp(tokens, position + 1, ['(']):
+                raise ValueError('abs must be followed by (')
+            node, position = Selection._parseOr(tokens, position + 2)
+            return ('abs', node), Selection._expectClosing(tokens, position)
+        if token_type == 'name':
+            return ('key', value), position + 1
+
+        raise ValueError(f'unexpected {value} in selection')
+
+    @staticmethod
+    def _expectClosing(tokens, position):
+        if not Selection._isOp(tokens, position, [')']):
+            raise ValueError('missing ) in selection')
+        return position + 1
+
+    @staticmethod
+    def _isOp(tokens, position, ops):
+        return position < len(tokens) and tokens[position][0] == 'op'\
+               and tokens[position][1] in ops
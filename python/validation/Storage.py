@@ -0,0 +1,174 @@
+# This file contains storage backends for NTuples (histograms produced by
+# NTupler and read by Plotter).
+#
+# Each histogram is a dictionary of the following form:
+#       {"data": counts, "data_bin_edges": edges, "c_data_bin_edges": c_edges}
+#
+# Available backends (chosen by extension of the file with openStorage()):
+#       .json -> JSONStorage. Human readable, the whole file is parsed at once.
+#       .npz  -> NPZStorage. Counts and edges are stored as typed NumPy arrays
+#                in an uncompressed .npz container. Histograms are loaded lazily
+#                by name and arrays are memory-mapped (mmap=True).
+#
+# Storages behave like read-only dictionaries {histogram name: histogram}.
+# write() replaces the file atomically (temporary file + rename).
+# Use convert() to export a file to another format, e.g. .npz -> .json.
+import json
+import os
+import zipfile
+import numpy as np
+from abc import ABC, abstractmethod
+from collections.abc import Mapping
+from typing import Dict
+
+class Storage(Mapping, ABC):
+    extension = None
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def write(self, histograms: Dict[str, Dict]):
+        # temporary file is created with the umask, as output itself would be
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as file:
+            self._dump(histograms, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+        self._reset()
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def read(self):
+        return {name: self[name] for name in self}
+
+    # Writes histograms to the open binary file
+    @abstractmethod
+    def _dump(self, histograms, file):
+        pass
+
+    # Drops what was loaded from the previous version of the file
+    @abstractmethod
+    def _reset(self):
+        pass
+
+class JSONStorage(Storage):
+    extension = '.json'
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.file = None
+
+    def __getitem__(self, name: str):
+        return self._load()[name]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def _load(self):
+        if self.file is None:
+            if self.exists():
+                with open(self.path, 'r') as file:
+                    self.file = json.load(file)
+            else:
+                self.file = {}
+        return self.file
+
+    def _dump(self, histograms, file):
+        json_data = {}
+        for name, histogram in histograms.items():
+            json_data[name] = {key: np.asarray(value).tolist()\
+                               for key, value in histogram.items()}
+        file.write(json.dumps(json_data, indent=4).encode())
+
+    def _reset(self):
+        self.file = None
+
+class NPZStorage(Storage):
+    # Arrays of histogram "name" are stored as "name/data", "name/data_bin_edges"
+    # and "name/c_data_bin_edges" members of .npz file
+    extension = '.npz'
+
+    def __init__(self, path: str, mmap: bool = True):
+        super().__init__(path)
+        self.mmap = mmap
+        self.members = None
+
+    def __getitem__(self, name: str):
+        members = self._index()
+        if name not in members:
+            raise KeyError(f'histogram {name} is unavailable in {self.path}')
+        return {key: self._loadArray(member) for key, member in members[name].items()}
+
+    def __iter__(self):
+        return iter(self._index())
+
+    def __len__(self):
+        return len(self._index())
+
+    # Reads only the list of members: {histogram name: {key: member name}}
+    def _index(self):
+        if self.members is None:
+            self.members = {}
+            if self.exists():
+                with zipfile.ZipFile(self.path) as file:
+                    for member in file.namelist():
+                        name, key = member[:-len('.npy')].rsplit('/', 1)
+                        self.members.setdefault(name, {})[key] = member
+        return self.members
+
+    def _loadArray(self, member: str):
+        with zipfile.ZipFile(self.path) as file:
+            info = file.getinfo(member)
+            if self.mmap and info.compress_type == zipfile.ZIP_STORED:
+                return self._mapArray(info)
+            with file.open(member) as array_file:
+                return np.lib.format.read_array(array_file)
+
+    # Uncompressed members are memory-mapped: the .npy header is read to find
+    # dtype, shape and the offset of data in the .npz file
+    def _mapArray(self, info: zipfile.ZipInfo):
+        with open(self.path, 'rb') as file:
+            file.seek(info.header_offset)
+            local_header = file.read(30)
+            name_length = int.from_bytes(local_header[26:28], 'little')
+            extra_length = int.from_bytes(local_header[28:30], 'little')
+            file.seek(info.header_offset + 30 + name_length + extra_length)
+
+            version = np.lib.format.read_magic(file)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+            offset = file.tell()
+
+        if np.prod(shape) == 0:
+            return np.zeros(shape, dtype=dtype)
+        order = 'F' if fortran_order else 'C'
+        return np.memmap(self.path, dtype=dtype, mode='r', offset=offset,\
+                         shape=shape, order=order)
+
+    def _dump(self, histograms, file):
+        arrays = {}
+        for name, histogram in histograms.items():
+            for key, value in histogram.items():
+                arrays[f'{name}/{key}'] = np.asarray(value)
+        np.savez(file, **arrays)
+
+    def _reset(self):
+        self.members = None
+
+def openStorage(path: str):
+    storages = {storage.extension: storage for storage in [JSONStorage, NPZStorage]}
+    extension = os.path.splitext(path)[1]
+    if extension not in storages:
+        raise ValueError(f'unknown NTuple format {extension}. Available formats:'\
+                         + f' {list(storages.keys())}')
+    return storages[extension](path)
+
+def convert(input: str, output: str):
+    openStorage(output).write(openStorage(input).read())